@@ -10,7 +10,7 @@
 # 5. Thêm debug log cho find_target_matches + query_database_all
 # 6. Bỏ duplicate import re
 # 7. Animation dừng đúng khi confirm/cancel
-# 8. Tách hàm _match_keyword_to_title chung → tránh duplicate logic match
+# 8. Logic match tập trung ở keyword_matcher / search_title_index → tránh duplicate logic match
 # 9. Tách hàm find_children_by_relation → tìm ngày theo relation thay vì tên
 
 import os
@@ -21,14 +21,29 @@ import re
 import math
 import json
 import time
-import traceback
+import queue
+import random
+import atexit
+import logging
 import threading
 import requests
 import unicodedata
-from datetime import datetime, timedelta, timezone
-from typing import Dict, Any, List, Optional, Tuple
-from flask import Flask, request, jsonify
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from logging.handlers import QueueHandler, QueueListener
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from functools import lru_cache
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Any, Callable, Deque, List, Optional, Tuple
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from dotenv import load_dotenv
+try:
+    import orjson  # nhanh hơn json stdlib 3-5x; thiếu thì fallback
+except ImportError:
+    orjson = None
 load_dotenv("/root/app/.env")
 
 # ------------- CONFIG -------------
@@ -46,30 +61,170 @@ TONG_THU_DONG_G_PAGE_ID = os.getenv("TONG_THU_DONG_G_PAGE_ID", "")  # Page ID c
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID", "")
+_ALLOWED_CHAT = TELEGRAM_CHAT_ID.strip() or None  # None = nhận mọi chat
 
 WAIT_CONFIRM = int(os.getenv("WAIT_CONFIRM", "120"))
-PATCH_DELAY = float(os.getenv("PATCH_DELAY", "0.3"))
 MAX_QUERY_PAGE_SIZE = int(os.getenv("MAX_QUERY_PAGE_SIZE", "100"))
+WORKERS = int(os.getenv("WORKERS", "32"))
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", str(WORKERS * 4)))  # update chờ + đang chạy tối đa
+DB_CACHE_TTL = float(os.getenv("DB_CACHE_TTL", "30"))  # giây; 0 = tắt cache query DB
+NOTION_RPS = float(os.getenv("NOTION_RPS", "3"))  # Notion giới hạn ~3 request/giây
+NOTION_WORKERS = int(os.getenv("NOTION_WORKERS", "5"))
+COMMAND_DEBOUNCE = float(os.getenv("COMMAND_DEBOUNCE", "0.3"))  # giây; 0 = tắt
+UNDO_HISTORY = int(os.getenv("UNDO_HISTORY", "32"))  # số thao tác gần nhất giữ để undo / chat
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "1.0"))  # giây giữa 2 lần edit progress
 
 VN_TZ = timezone(timedelta(hours=7))
+TELEGRAM_MAX_TEXT = 4000  # Telegram giới hạn 4096 ký tự / tin
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def json_dumps_bytes(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# ------------- LOGGING -------------
+# Format + traceback chạy trên thread của QueueListener, không chặn thread xử lý
+class _DeferredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+logger = logging.getLogger(__name__)
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(threadName)s] chat=%(chat_id)s %(message)s"))
+
+
+def _default_chat_id(record):
+    if not hasattr(record, "chat_id"):
+        record.chat_id = "-"
+    return True
+
+
+_log_stream.addFilter(_default_chat_id)
+_log_listener = QueueListener(_log_queue, _log_stream)
+logger.addHandler(_DeferredQueueHandler(_log_queue))
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+logger.propagate = False
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
 # ------------- IN-MEM STATE -------------
-pending_confirm: Dict[str, Dict[str, Any]] = {}
-undo_stack: Dict[str, List[Dict[str, Any]]] = {}
-_animation_stop: Dict[str, bool] = {}  # FIX #1: cờ dừng animation riêng
+@dataclass(slots=True)
+class PendingAction:
+    """Thao tác đang chờ user trả lời (chọn index hoặc /ok). Field nào không dùng thì để mặc định."""
+    type: str
+    expires: float
+    timer_message_id: Optional[int] = None
+    keyword: str = ""
+    title: str = ""
+    matches: list = field(default_factory=list)
+    checked: int = 0
+    unchecked: int = 0
+    targets: list = field(default_factory=list)
+    preview_text: str = ""
+    target_id: Optional[str] = None
+    props: dict = field(default_factory=dict)
+    children: list = field(default_factory=list)
+
+
+pending_confirm: Dict[int, PendingAction] = {}  # key = chat_id (int)
+_pending_lock = threading.Lock()  # giữ check-rồi-pop của sweeper không đụng thread xử lý
+# key = chat_id (int); deque(maxlen) → chỉ giữ UNDO_HISTORY thao tác gần nhất, bộ nhớ không phình
+undo_stack: Dict[int, Deque[Dict[str, Any]]] = defaultdict(lambda: deque(maxlen=UNDO_HISTORY))
+_animation_stop: Dict[int, bool] = {}  # FIX #1: cờ dừng animation riêng
+_DB_CACHE: Dict[Tuple[str, str], Tuple[float, List[Dict[str, Any]], dict]] = {}  # (db_id, filter) -> (ts, pages, memo)
+_db_cache_lock = threading.Lock()
+_db_cache_gen = 0  # tăng mỗi lần invalidate
+_db_inflight: Dict[Tuple[str, str], threading.Event] = {}  # key đang được query (single-flight)
+_recent_commands: Dict[Tuple[int, str], float] = {}  # (chat_id, text) -> lần nhận gần nhất
+_recent_commands_lock = threading.Lock()
+_seen_updates: "OrderedDict[int, None]" = OrderedDict()  # update_id đã nhận (LRU)
+_seen_updates_lock = threading.Lock()
+SEEN_UPDATES_MAX = 4096
+
+# Pool dùng chung cho mọi update → không sinh thread mới cho từng tin nhắn
+EXECUTOR = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="tg")
+
+
+class RateLimiter:
+    """Token bucket: mọi thread dùng chung 1 nhịp request/giây."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(self._next, now) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+NOTION_LIMITER = RateLimiter(NOTION_RPS)
+# Pool riêng cho các PATCH hàng loạt; nhịp do NOTION_LIMITER quyết định
+NOTION_POOL = ThreadPoolExecutor(max_workers=NOTION_WORKERS, thread_name_prefix="notion")
+
+
+def submit_task(fn, *args) -> bool:
+    try:
+        EXECUTOR.submit(fn, *args)
+        return True
+    except RuntimeError as e:
+        logger.warning("submit_task rejected %s: %s", getattr(fn, "__name__", fn), e)
+        return False
+
+
+# Queue của EXECUTOR không giới hạn → đếm slot riêng cho update từ Telegram để báo bận khi quá tải
+_update_slots = threading.BoundedSemaphore(MAX_PENDING_UPDATES)
+
+
+def submit_update(fn, chat_id: int, *args) -> bool:
+    """Như submit_task(fn, chat_id, *args) nhưng tối đa MAX_PENDING_UPDATES update chờ/chạy; hết slot → False."""
+    if not _update_slots.acquire(blocking=False):
+        logger.warning("submit_update rejected: quá MAX_PENDING_UPDATES=%d", MAX_PENDING_UPDATES,
+                       extra={"chat_id": chat_id})
+        return False
+    try:
+        fut = EXECUTOR.submit(fn, chat_id, *args)
+    except RuntimeError as e:
+        _update_slots.release()
+        logger.warning("submit_update rejected: %s", e, extra={"chat_id": chat_id})
+        return False
+    fut.add_done_callback(lambda _: _update_slots.release())
+    return True
 
 
 # =====================================================================
 #  TELEGRAM HELPERS
 # =====================================================================
+# Session dùng chung → giữ kết nối keep-alive tới api.telegram.org
+TG_SESSION = requests.Session()
+TG_SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=256,
+                                         max_retries=Retry(total=2, backoff_factor=0.1)))
+
+
 def send_telegram(chat_id, text, parse_mode=None):
     url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
     payload = {"chat_id": chat_id, "text": text}
     if parse_mode:
         payload["parse_mode"] = parse_mode
     try:
-        r = requests.post(url, json=payload, timeout=10)
-        data = r.json()
+        r = TG_SESSION.post(url, data=json_dumps_bytes(payload), headers=JSON_HEADERS, timeout=10)
+        data = json_loads(r.content)
         if not data.get("ok"):
             print("send_telegram failed:", data)
             return {}
@@ -87,8 +242,8 @@ def edit_telegram_message(chat_id, message_id, new_text, parse_mode=None):
     if parse_mode:
         payload["parse_mode"] = parse_mode
     try:
-        r = requests.post(url, json=payload, timeout=10)
-        data = r.json()
+        r = TG_SESSION.post(url, data=json_dumps_bytes(payload), headers=JSON_HEADERS, timeout=10)
+        data = json_loads(r.content)
         if not data.get("ok"):
             print("edit_telegram_message failed:", data)
             return {}
@@ -98,10 +253,26 @@ def edit_telegram_message(chat_id, message_id, new_text, parse_mode=None):
         return {}
 
 
+def throttled_progress(update: Callable[[str], Any], min_interval: float = PROGRESS_EDIT_INTERVAL):
+    """Bọc update(text) cho vòng progress: chỉ edit khi đã qua min_interval từ lần trước (hoặc final=True)
+    → Telegram nhận ≤1 edit/giây, vòng Notion không phải sleep để giữ nhịp edit.
+    """
+    last = 0.0
+
+    def progress(text: str, final: bool = False):
+        nonlocal last
+        now = time.monotonic()
+        if final or now - last >= min_interval:
+            last = now
+            update(text)
+
+    return progress
+
+
 def start_waiting_animation(chat_id: int, message_id: int, duration: int = 120,
                             interval: float = 2.0, label: str = "đang chờ"):
     """FIX #1: animation loop kiểm tra _animation_stop để dừng đúng lúc."""
-    key = str(chat_id)
+    key = chat_id
     _animation_stop[key] = False
 
     def animate():
@@ -125,24 +296,67 @@ def start_waiting_animation(chat_id: int, message_id: int, duration: int = 120,
             except Exception as e:
                 print("⚠️ lỗi khi gửi thông báo hết hạn:", e)
 
-    threading.Thread(target=animate, daemon=True).start()
+    threading.Thread(target=animate, name=f"tg-anim:{chat_id}", daemon=True).start()
 
 
-def stop_waiting_animation(chat_id):
-    """FIX #1: đặt cờ dừng → animation thread thoát ngay."""
-    key = str(chat_id)
-    _animation_stop[key] = True
-    if key in pending_confirm:
-        pending_confirm[key]["expires"] = 0
+def set_pending(chat_id: int, action: PendingAction):
+    with _pending_lock:
+        pending_confirm[chat_id] = action
+
+
+def take_pending(chat_id: int, expected: Optional[PendingAction] = None) -> Optional[PendingAction]:
+    """Nhận (pop) thao tác chờ dưới lock. Trả None nếu sweeper / thread khác đã lấy trước,
+    hoặc entry đã bị thay khác `expected` → caller coi như hết hạn, không xử lý tiếp.
+    """
+    with _pending_lock:
+        item = pending_confirm.get(chat_id)
+        if item is None or (expected is not None and item is not expected):
+            return None
+        del pending_confirm[chat_id]
+        return item
+
 
+def clear_pending(chat_id: int):
+    with _pending_lock:
+        pending_confirm.pop(chat_id, None)
 
-def send_long_text(chat_id: str, text: str):
-    max_len = 3000
-    for i in range(0, len(text), max_len):
-        send_telegram(chat_id, text[i:i + max_len])
+
+def stop_waiting_animation(chat_id):
+    """FIX #1: đặt cờ dừng → animation thread thoát ngay."""
+    _animation_stop[chat_id] = True
+    with _pending_lock:
+        item = pending_confirm.get(chat_id)
+        if item:
+            item.expires = 0
 
 
-def send_progress(chat_id: str, step: int, total: int, label: str):
+def send_long_text(chat_id: int, text: str):
+    """Chia theo dòng, mỗi tin <= TELEGRAM_MAX_TEXT ký tự; dòng quá dài thì cắt cứng.
+    Gửi tuần tự để giữ đúng thứ tự các phần.
+    """
+    max_len = TELEGRAM_MAX_TEXT
+    buf: List[str] = []
+    size = 0
+    for ln in text.splitlines(keepends=True):
+        while len(ln) > max_len:
+            if buf:
+                send_telegram(chat_id, "".join(buf))
+                buf.clear()
+                size = 0
+            send_telegram(chat_id, ln[:max_len])
+            ln = ln[max_len:]
+        if size + len(ln) > max_len:
+            send_telegram(chat_id, "".join(buf))
+            time.sleep(0.1)
+            buf.clear()
+            size = 0
+        buf.append(ln)
+        size += len(ln)
+    if buf:
+        send_telegram(chat_id, "".join(buf))
+
+
+def send_progress(chat_id: int, step: int, total: int, label: str):
     try:
         if total == 0:
             return
@@ -155,52 +369,150 @@ def send_progress(chat_id: str, step: int, total: int, label: str):
 # =====================================================================
 #  NOTION API WRAPPERS
 # =====================================================================
-def _notion_post(url: str, json_body: dict, attempts: int = 3, timeout: int = 15):
-    for i in range(attempts):
+# Session riêng cho Notion: keep-alive + header cố định; retry do các wrapper tự lo
+NOTION_SESSION = requests.Session()
+NOTION_SESSION.headers.update(NOTION_HEADERS)
+NOTION_SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=0))
+
+NOTION_API = "https://api.notion.com/v1"
+NOTION_PAGES_URL = f"{NOTION_API}/pages"
+
+
+def _page_url(page_id: str) -> str:
+    return f"{NOTION_PAGES_URL}/{page_id}"
+
+
+def _db_query_url(database_id: str) -> str:
+    return f"{NOTION_API}/databases/{database_id}/query"
+
+
+def _backoff_delay(attempt: int, resp: Optional[requests.Response] = None) -> float:
+    """Exponential backoff + jitter (tránh mọi worker retry cùng lúc); 429 thì theo Retry-After."""
+    if resp is not None and resp.status_code == 429:
         try:
-            r = requests.post(url, headers=NOTION_HEADERS, json=json_body, timeout=timeout)
-            if r.status_code in (200, 201):
-                return True, r.json()
-            if r.status_code >= 500:
-                time.sleep(1 + i)
-                continue
-            return False, {"status": r.status_code, "text": r.text}
-        except Exception as e:
-            last_exc = e
-            time.sleep(1 + i)
-    return False, str(last_exc)
+            return float(resp.headers.get("Retry-After", "1"))
+        except ValueError:
+            return 1.0
+    return min(8.0, 0.5 * 2 ** attempt + random.random() * 0.5)
 
 
-def _notion_patch(url: str, json_body: dict, attempts: int = 3, timeout: int = 12):
+def _notion_request(method: str, url: str, json_body: dict, ok_codes: Tuple[int, ...],
+                    attempts: int = 3, timeout: int = 15):
+    """Gọi Notion có retry cho lỗi mạng / 429 / 5xx; lỗi 4xx khác trả về ngay."""
+    last_err: Any = "no attempt"
     for i in range(attempts):
+        retry_wait = None
         try:
-            r = requests.patch(url, headers=NOTION_HEADERS, json=json_body, timeout=timeout)
-            if r.status_code in (200, 204):
+            r = NOTION_SESSION.request(method, url, data=json_dumps_bytes(json_body), timeout=timeout)
+            if r.status_code in ok_codes:
                 try:
-                    return True, r.json() if r.text else {}
+                    return True, json_loads(r.content) if r.content else {}
                 except Exception:
                     return True, {}
-            if r.status_code >= 500:
-                time.sleep(1 + i)
-                continue
-            return False, {"status": r.status_code, "text": r.text}
+            last_err = {"status": r.status_code, "text": r.text}
+            if r.status_code != 429 and r.status_code < 500:
+                return False, last_err
+            retry_wait = _backoff_delay(i, r)
         except Exception as e:
-            last_exc = e
-            time.sleep(1 + i)
-    return False, str(last_exc)
+            last_err = str(e)
+            retry_wait = _backoff_delay(i)
+        if i + 1 < attempts:
+            time.sleep(retry_wait)
+    return False, last_err
+
+
+def _notion_post(url: str, json_body: dict, attempts: int = 3, timeout: int = 15):
+    return _notion_request("POST", url, json_body, (200, 201), attempts, timeout)
+
+
+def _notion_patch(url: str, json_body: dict, attempts: int = 3, timeout: int = 12):
+    return _notion_request("PATCH", url, json_body, (200, 204), attempts, timeout)
+
+
+def invalidate_db_cache(database_id: Optional[str] = None):
+    """Xóa cache query của 1 DB, hoặc toàn bộ khi không biết page thuộc DB nào."""
+    global _db_cache_gen
+    with _db_cache_lock:
+        _db_cache_gen += 1
+        if database_id:
+            for key in [k for k in _DB_CACHE if k[0] == database_id]:
+                del _DB_CACHE[key]
+        else:
+            _DB_CACHE.clear()
+
+
+def query_database_all(database_id: str, page_size: int = MAX_QUERY_PAGE_SIZE, _retries: int = 5,
+                       filter: Optional[dict] = None) -> List[Dict[str, Any]]:
+    """Query all pages with retry + increased timeout.
+    Kết quả được cache DB_CACHE_TTL giây (theo DB + filter) để gom các lệnh gõ liên tiếp.
+    Trả về bản sao riêng → caller sửa thoải mái, không đụng snapshot.
+    """
+    results, _ = _query_snapshot(database_id, page_size, _retries, filter)
+    return snapshot_copy(results)
+
 
+def snapshot_copy(obj):
+    """Deep copy dữ liệu lấy từ snapshot cache (JSON thuần → round-trip JSON, nhanh với orjson)."""
+    return json_loads(json_dumps_bytes(obj))
 
-def query_database_all(database_id: str, page_size: int = MAX_QUERY_PAGE_SIZE, _retries: int = 5) -> List[Dict[str, Any]]:
-    """Query all pages with retry + increased timeout."""
+
+def _query_snapshot(database_id: str, page_size: int = MAX_QUERY_PAGE_SIZE, _retries: int = 5,
+                    filter: Optional[dict] = None) -> Tuple[List[Dict[str, Any]], dict]:
+    """Trả về (pages, memo) của snapshot cache — KHÔNG copy: pages, props và memo là CHỈ ĐỌC,
+    dùng chung cho mọi lệnh trong DB_CACHE_TTL giây. Cần sửa thì snapshot_copy() trước.
+    memo sống cùng snapshot, dùng để giữ dữ liệu dẫn xuất (vd. title index).
+    """
     if not NOTION_TOKEN:
         print("[query_database_all] SKIP — NOTION_TOKEN is EMPTY")
-        return []
+        return [], {}
     if not database_id:
         print("[query_database_all] SKIP — database_id is EMPTY")
-        return []
+        return [], {}
+
+    cache_key = (database_id, json.dumps(filter, sort_keys=True) if filter else "")
+    # Đọc không lock: dict.get là atomic, entry là tuple bất biến → thấy bản cũ hoặc mới, không bao giờ nửa vời
+    hit = _DB_CACHE.get(cache_key)
+    if hit and time.time() - hit[0] < DB_CACHE_TTL:
+        return hit[1], hit[2]
+
+    # Single-flight: nhiều thread cùng miss 1 key thì chỉ 1 thread query Notion, số còn lại chờ kết quả
+    with _db_cache_lock:
+        inflight = _db_inflight.get(cache_key)
+        leader = inflight is None
+        if leader:
+            inflight = _db_inflight[cache_key] = threading.Event()
+        gen = _db_cache_gen
+    if not leader:
+        inflight.wait(timeout=120)
+        hit = _DB_CACHE.get(cache_key)
+        if hit and time.time() - hit[0] < DB_CACHE_TTL:
+            return hit[1], hit[2]
+        # leader lỗi / cache bị xóa giữa chừng → tự query, không đợi nữa
 
+    try:
+        results, complete = _fetch_database_pages(database_id, page_size, _retries, filter)
+        memo: dict = {}
+        if complete and DB_CACHE_TTL > 0:
+            with _db_cache_lock:
+                if gen == _db_cache_gen:  # có ghi Notion trong lúc query → không cache bản có thể đã cũ
+                    now = time.time()
+                    # bỏ entry đã hết hạn (mỗi target có key filter riêng → không dọn thì tích mãi)
+                    for key in [k for k, v in _DB_CACHE.items() if now - v[0] >= DB_CACHE_TTL]:
+                        del _DB_CACHE[key]
+                    _DB_CACHE[cache_key] = (now, results, memo)
+        return results, memo
+    finally:
+        if leader:
+            with _db_cache_lock:
+                _db_inflight.pop(cache_key, None)
+            inflight.set()
+
+
+def _fetch_database_pages(database_id: str, page_size: int, _retries: int,
+                          filter: Optional[dict]) -> Tuple[List[Dict[str, Any]], bool]:
+    """Phân trang hết DB. Trả về (pages, complete); complete=False khi bỏ cuộc giữa chừng."""
     db_short = database_id[:16]
-    url = f"https://api.notion.com/v1/databases/{database_id}/query"
+    url = _db_query_url(database_id)
     # Notion cho phép page_size tối đa 100, dùng 100 để ít request nhất
     actual_page_size = min(page_size, 100)
 
@@ -209,24 +521,32 @@ def query_database_all(database_id: str, page_size: int = MAX_QUERY_PAGE_SIZE, _
 
     while True:
         payload: dict = {"page_size": actual_page_size}
+        if filter:
+            payload["filter"] = filter
         if cursor:
             payload["start_cursor"] = cursor
 
         for attempt in range(1, _retries + 1):
             try:
-                r = requests.post(url, headers=NOTION_HEADERS, json=payload, timeout=45)
+                r = NOTION_SESSION.post(url, data=json_dumps_bytes(payload), timeout=45)
                 if r.status_code == 200:
                     break
                 print(f"[query_database_all] status={r.status_code} attempt={attempt} db={db_short}")
-                time.sleep(2 * attempt)
+                if r.status_code != 429 and r.status_code < 500:
+                    # 4xx khác (filter sai, không có quyền...) → retry cũng vô ích
+                    print(f"[query_database_all] GIVE UP db={db_short}: {r.text[:200]}")
+                    return results, False
+                retry_wait = _backoff_delay(attempt, r)
             except Exception as e:
                 print(f"[query_database_all] EXCEPTION attempt={attempt} db={db_short}: {e}")
-                time.sleep(2 * attempt)
+                retry_wait = _backoff_delay(attempt)
+            if attempt < _retries:
+                time.sleep(retry_wait)
         else:
             print(f"[query_database_all] GIVE UP after {_retries} attempts db={db_short}, got {len(results)} so far")
-            return results
+            return results, False
 
-        data = r.json()
+        data = json_loads(r.content)
         results.extend(data.get("results", []))
 
         if not data.get("has_more"):
@@ -234,69 +554,112 @@ def query_database_all(database_id: str, page_size: int = MAX_QUERY_PAGE_SIZE, _
         cursor = data.get("next_cursor")
 
     print(f"[query_database_all] OK db={db_short}... total_pages={len(results)}")
-    return results
+    return results, True
 
 
 def create_page_in_db(database_id: str, properties: Dict[str, Any]) -> Tuple[bool, Any]:
     if not NOTION_TOKEN or not database_id:
         return False, "Notion config missing"
-    url = "https://api.notion.com/v1/pages"
+    url = NOTION_PAGES_URL
     body = {"parent": {"database_id": database_id}, "properties": properties}
-    return _notion_post(url, body)
+    ok, res = _notion_post(url, body)
+    if ok:
+        invalidate_db_cache(database_id)
+    return ok, res
 
 
 def archive_page(page_id: str) -> Tuple[bool, str]:
     if not NOTION_TOKEN or not page_id:
         return False, "Notion config missing"
-    url = f"https://api.notion.com/v1/pages/{page_id}"
-    return _notion_patch(url, {"archived": True})
+    url = _page_url(page_id)
+    ok, res = _notion_patch(url, {"archived": True})
+    if ok:
+        invalidate_db_cache()
+    return ok, res
 
 
 def unarchive_page(page_id: str) -> Tuple[bool, str]:
     if not NOTION_TOKEN or not page_id:
         return False, "Notion config missing"
-    url = f"https://api.notion.com/v1/pages/{page_id}"
-    return _notion_patch(url, {"archived": False})
+    url = _page_url(page_id)
+    ok, res = _notion_patch(url, {"archived": False})
+    if ok:
+        invalidate_db_cache()
+    return ok, res
 
 
 def update_page_properties(page_id: str, properties: Dict[str, Any]) -> Tuple[bool, Any]:
     if not NOTION_TOKEN or not page_id:
         return False, "Notion config missing"
-    url = f"https://api.notion.com/v1/pages/{page_id}"
-    return _notion_patch(url, {"properties": properties})
+    url = _page_url(page_id)
+    ok, res = _notion_patch(url, {"properties": properties})
+    if ok:
+        invalidate_db_cache()
+    return ok, res
 
 
-def update_checkbox(page_id: str, checked: bool) -> Tuple[bool, Any]:
+def update_checkbox(page_id: str, checked: bool, cb_key: str = "Đã Góp") -> Tuple[bool, Any]:
     if not NOTION_TOKEN or not page_id:
         return False, "Notion config missing"
-    return update_page_properties(page_id, {"Đã Góp": {"checkbox": checked}})
+    return update_page_properties(page_id, {cb_key: {"checkbox": checked}})
 
 
 # =====================================================================
 #  PROPERTY EXTRACTION & PARSING
 # =====================================================================
+_TOKEN_SPLIT_RE = re.compile(r'[^a-z0-9]+')
+_GCODE_RE = re.compile(r'^g0*([0-9]+)$')
+_MONEY_RE = re.compile(r"-?\d+\.?\d*")
+
+
+def _build_strip_table() -> Dict[int, Optional[str]]:
+    """Bảng translate bỏ dấu cho khối Latin (gồm tiếng Việt) + xóa dấu kết hợp rời (U+0300–036F)."""
+    table: Dict[int, Optional[str]] = {}
+    for cp in list(range(0x00C0, 0x0250)) + list(range(0x1E00, 0x1F00)):
+        c = chr(cp)
+        stripped = "".join(x for x in unicodedata.normalize("NFD", c) if unicodedata.category(x) != "Mn")
+        if stripped != c:
+            table[cp] = stripped
+    for cp in range(0x0300, 0x0370):
+        if unicodedata.category(chr(cp)) == "Mn":
+            table[cp] = None
+    return table
+
+
+_STRIP_TABLE = _build_strip_table()
+_OUTSIDE_STRIP_TABLE_RE = re.compile("[^\x00-\u024f\u1e00-\u1eff]")  # còn ký tự bảng chưa phủ → NFD
+
+
 def normalize_text(s: Optional[str]) -> str:
     if not s:
         return ""
-    s = str(s).strip().lower()
+    s = str(s).strip().casefold()
+    if s.isascii():  # không dấu → NFD không đổi gì, bỏ qua
+        return s
+    s = s.translate(_STRIP_TABLE)  # tiếng Việt: 1 lượt translate ở tầng C
+    if not _OUTSIDE_STRIP_TABLE_RE.search(s):
+        return s
+    # ký tự ngoài bảng (script khác...) → đường chậm NFD
     nf = unicodedata.normalize("NFD", s)
     return "".join(c for c in nf if unicodedata.category(c) != "Mn")
 
 
+def _split_tokens(normalized: str) -> List[str]:
+    return [x for x in _TOKEN_SPLIT_RE.split(normalized) if x]
+
+
 def tokenize_title(title: str) -> List[str]:
     if not title:
         return []
-    t = normalize_text(title)
-    tokens = re.split(r'[^a-z0-9]+', t)
-    return [x for x in tokens if x]
+    return _split_tokens(normalize_text(title))
 
 
 def normalize_gcode(token: str) -> str:
     if not token:
         return token
-    m = re.match(r'^(g)0*([0-9]+)$', token)
+    m = _GCODE_RE.match(token)
     if m:
-        return f"g{int(m.group(2))}"
+        return f"g{int(m.group(1))}"
     return token
 
 
@@ -306,19 +669,36 @@ def extract_plain_text_from_rich_text(arr: List[Dict[str, Any]]) -> str:
     return "".join([x.get("plain_text", "") for x in arr if isinstance(x, dict)])
 
 
+@lru_cache(maxsize=1024)
+def _norm_key(name: str) -> str:
+    """normalize_text cho tên property — tập tên nhỏ, lặp lại ở mọi page."""
+    return normalize_text(name)
+
+
 def find_prop_key(props: Dict[str, Any], name_like: str) -> Optional[str]:
     if not props:
         return None
-    nl = normalize_text(name_like)
-    for k in props.keys():
-        if normalize_text(k) == nl:
+    return _resolve_prop_key(tuple(props), name_like)
+
+
+@lru_cache(maxsize=512)
+def _resolve_prop_key(keys: Tuple[str, ...], name_like: str) -> Optional[str]:
+    """Các page cùng DB có cùng bộ key → kết quả dò tên property chỉ tính 1 lần cho mỗi schema."""
+    nl = _norm_key(name_like)
+    keymap = [(k, _norm_key(k)) for k in keys]
+    for k, nk in keymap:
+        if nk == nl:
             return k
-    for k in props.keys():
-        if nl in normalize_text(k):
+    for k, nk in keymap:
+        if nl in nk:
             return k
     return None
 
 
+def find_checkbox_key(props: Dict[str, Any]) -> Optional[str]:
+    return find_prop_key(props, "Đã Góp") or find_prop_key(props, "Sent") or find_prop_key(props, "Status")
+
+
 def extract_prop_text(props: Dict[str, Any], key_like: str) -> str:
     if not props:
         return ""
@@ -390,7 +770,7 @@ def parse_money_from_text(s: Optional[str]) -> float:
         return 0.0
     try:
         s2 = str(s).replace(",", "")
-        m = re.search(r"-?\d+\.?\d*", s2)
+        m = _MONEY_RE.search(s2)
         if not m:
             return 0.0
         return float(m.group(0))
@@ -402,32 +782,98 @@ def _num(props, key_like):
     return parse_money_from_text(extract_prop_text(props, key_like)) or 0
 
 
+def _lai_amount(props) -> float:
+    """Số Lãi của target: thử lần lượt "Lai lịch g" → "Lãi" → "Lai" (cột nào có giá trị trước)."""
+    lai_text = (
+        extract_prop_text(props, "Lai lịch g")
+        or extract_prop_text(props, "Lãi")
+        or extract_prop_text(props, "Lai")
+        or ""
+    )
+    return parse_money_from_text(lai_text) or 0
+
+
 # =====================================================================
 #  MATCHING HELPERS  (FIX #8: logic match tập trung 1 chỗ)
 # =====================================================================
-def _match_keyword_to_title(kw: str, title: str) -> bool:
-    """
-    Logic match chung: so sánh keyword (đã normalize) với title.
-    """
-    title_clean = normalize_text(title)
-    tokens = tokenize_title(title)
+def gcode_set(tokens: List[str]) -> frozenset:
+    """Các token dạng g-code của title, đã chuẩn hóa (g05 → g5) → tra kw g-code O(1)."""
+    return frozenset(normalize_gcode(tk) for tk in tokens if tk[:1] == "g" and tk[1:].isdigit())
 
-    is_gcode = bool(re.match(r'^g[0-9]+$', kw))
-    kw_g = normalize_gcode(kw) if is_gcode else None
 
-    if title_clean == kw:
-        return True
-    if is_gcode:
-        for tk in tokens:
-            if normalize_gcode(tk) == kw_g:
-                return True
-    if not is_gcode:
-        for tk in tokens:
-            if kw in tk:
+def keyword_gcode(kw: str) -> Optional[str]:
+    """kw dạng g-code (g5, g05...) → dạng chuẩn hóa; không phải thì None."""
+    return normalize_gcode(kw) if _GCODE_RE.match(kw) else None
+
+
+def keyword_matcher(kw: str) -> Callable[[str, List[str], frozenset], bool]:
+    """Phân tích keyword 1 lần (g-code? prefix?) rồi trả về hàm match(title_clean, tokens, gcodes)
+    để dùng lại cho cả vòng quét DB.
+    """
+    kw_g = keyword_gcode(kw)
+    is_gcode = kw_g is not None
+    prefix = kw + "-"
+
+    def match(title_clean: str, tokens: List[str], gcodes: frozenset) -> bool:
+        if title_clean == kw:
+            return True
+        if is_gcode:
+            if kw_g in gcodes:
                 return True
-    if title_clean.startswith(kw + "-"):
-        return True
-    return False
+        else:
+            for tk in tokens:
+                if kw in tk:
+                    return True
+        return title_clean.startswith(prefix)
+
+    return match
+
+
+def build_title_index(pages: List[Dict[str, Any]]) -> List[Tuple[str, str, str, List[str], frozenset, Dict[str, Any]]]:
+    """Mỗi page có title → (pid, title, title_clean, tokens, gcodes, props). props là của snapshot → chỉ đọc."""
+    rows = []
+    # vòng quét cả DB → hoist global/method ra local
+    extract, norm, split, gset, append = extract_prop_text, normalize_text, _split_tokens, gcode_set, rows.append
+    intern = sys.intern
+    for p in pages:
+        props = p.get("properties", {})
+        title = extract(props, "Name") or extract(props, "Title") or ""
+        if not title:
+            continue
+        title_clean = norm(title)
+        tokens = [intern(t) for t in split(title_clean)]  # token lặp nhiều giữa các page → dùng chung 1 object
+        append((p.get("id"), title, title_clean, tokens, gset(tokens), props))
+    return rows
+
+
+def _title_index_and_memo(database_id: str, page_size: int = MAX_QUERY_PAGE_SIZE):
+    """Title index của DB (+ memo của snapshot), chỉ build lại khi snapshot cache đổi."""
+    pages, memo = _query_snapshot(database_id, page_size)
+    rows = memo.get("titles")
+    if rows is None:
+        rows = memo["titles"] = build_title_index(pages)
+    return rows, memo
+
+
+def search_title_index(database_id: str, kw: str, page_size: int = MAX_QUERY_PAGE_SIZE):
+    """Các row của title index khớp kw (đã normalize), giữ thứ tự DB.
+    kw g-code: title khớp ⇔ có token g-code bằng kw → tra thẳng inverted index g-code → row,
+    không quét cả DB.
+    """
+    rows, memo = _title_index_and_memo(database_id, page_size)
+    kw_g = keyword_gcode(kw)
+    if kw_g is None:
+        match = keyword_matcher(kw)
+        return [r for r in rows if match(r[2], r[3], r[4])]
+
+    by_gcode = memo.get("gcodes")
+    if by_gcode is None:
+        by_gcode = {}
+        for i, row in enumerate(rows):
+            for g in row[4]:
+                by_gcode.setdefault(g, []).append(i)
+        memo["gcodes"] = by_gcode
+    return [rows[i] for i in by_gcode.get(kw_g, ())]
 
 
 def find_target_matches(keyword: str, db_id: str = None, _pages: list = None):
@@ -449,19 +895,13 @@ def find_target_matches(keyword: str, db_id: str = None, _pages: list = None):
         return []
 
     if _pages is not None:
-        pages = _pages
+        match = keyword_matcher(kw)
+        rows = [r for r in build_title_index(_pages) if match(r[2], r[3], r[4])]
     else:
-        pages = query_database_all(db_id, page_size=10)
-    print(f"[find_target_matches] keyword='{kw}' pages_from_db={len(pages)}")
+        rows = search_title_index(db_id, kw, page_size=10)
 
-    out = []
-    for p in pages:
-        props = p.get("properties", {})
-        title = extract_prop_text(props, "Name") or extract_prop_text(props, "Title") or ""
-        if not title:
-            continue
-        if _match_keyword_to_title(kw, title):
-            out.append((p.get("id"), title, props))
+    # props đi tiếp vào PendingAction / các handler → bản sao riêng, không dùng chung với snapshot
+    out = [(pid, title, snapshot_copy(props)) for pid, title, title_clean, tokens, gcodes, props in rows]
 
     print(f"[find_target_matches] matched={len(out)} for kw='{kw}'")
     return out
@@ -476,41 +916,33 @@ def find_calendar_data(keyword: str):
         return [], 0, 0
     target_id = matches[0][0]
 
-    # Bước 2: query CALENDAR DB theo relation
-    url = f"https://api.notion.com/v1/databases/{NOTION_DATABASE_ID}/query"
-    payload = {
-        "page_size": 100,
-        "filter": {
-            "property": "Lịch G",
-            "relation": {"contains": target_id}
-        }
-    }
+    # Bước 2: query CALENDAR DB theo relation (dùng chung cache với query_database_all)
+    pages, memo = _query_snapshot(
+        NOTION_DATABASE_ID,
+        filter={"property": "Lịch G", "relation": {"contains": target_id}},
+    )
+    summary = memo.get("calendar")
+    if summary is None:
+        summary = memo["calendar"] = _summarize_calendar_pages(pages)
+    unchecked_matches, checked_count, unchecked_count = summary
+
+    # summary đã sort sẵn theo ngày; caller có thể sort/sửa list + props → trả bản sao
+    return ([(pid, title, date_iso, snapshot_copy(props)) for pid, title, date_iso, props in unchecked_matches],
+            checked_count, unchecked_count)
 
-    pages = []
-    while True:
-        r = requests.post(url, headers=NOTION_HEADERS, json=payload, timeout=45)
-        if r.status_code != 200:
-            print(f"[find_calendar_data] FAILED status={r.status_code}")
-            break
-        data = r.json()
-        pages.extend(data.get("results", []))
-        if not data.get("has_more"):
-            break
-        payload["start_cursor"] = data.get("next_cursor")
 
+def _summarize_calendar_pages(pages: List[Dict[str, Any]]):
+    """1 lượt qua các ngày của target → (unchecked rows sort theo ngày, số đã góp, số chưa góp); memo theo snapshot."""
     unchecked_matches = []
     checked_count = 0
     unchecked_count = 0
+    extract, find_cb, find_key, append = extract_prop_text, find_checkbox_key, find_prop_key, unchecked_matches.append
 
     for p in pages:
         props = p.get("properties", {})
-        title = extract_prop_text(props, "Name") or ""
+        title = extract(props, "Name") or ""
 
-        cb_key = (
-            find_prop_key(props, "Đã Góp")
-            or find_prop_key(props, "Sent")
-            or find_prop_key(props, "Status")
-        )
+        cb_key = find_cb(props)
         is_checked = bool(cb_key and props.get(cb_key, {}).get("checkbox"))
 
         if is_checked:
@@ -518,12 +950,12 @@ def find_calendar_data(keyword: str):
         else:
             unchecked_count += 1
             date_iso = None
-            date_key = find_prop_key(props, "Ngày Góp")
+            date_key = find_key(props, "Ngày Góp")
             if date_key:
                 df = props.get(date_key, {}).get("date")
                 if df:
                     date_iso = df.get("start")
-            unchecked_matches.append((p.get("id"), title, date_iso, props))
+            append((p.get("id"), title, date_iso, props))
 
     unchecked_matches.sort(key=lambda x: (x[2] is None, x[2] or ""))
     return unchecked_matches, checked_count, unchecked_count
@@ -543,18 +975,9 @@ def find_matching_all_pages_in_db(database_id: str, keyword: str, limit: int = 2
         return []
 
     kw = normalize_text(keyword)
-    pages = query_database_all(database_id, page_size=MAX_QUERY_PAGE_SIZE)
     out = []
 
-    for p in pages:
-        props = p.get("properties", {})
-        title = extract_prop_text(props, "Name") or extract_prop_text(props, "Title") or ""
-        if not title:
-            continue
-
-        if not _match_keyword_to_title(kw, title):
-            continue
-
+    for pid, title, title_clean, tokens, gcodes, props in search_title_index(database_id, kw):
         date_iso = None
         date_key = (
             find_prop_key(props, "Ngày")
@@ -564,7 +987,7 @@ def find_matching_all_pages_in_db(database_id: str, keyword: str, limit: int = 2
         if date_key and props.get(date_key, {}).get("date"):
             date_iso = props[date_key]["date"].get("start")
 
-        out.append((p.get("id"), title, date_iso))
+        out.append((pid, title, date_iso))
         if len(out) >= limit:
             break
 
@@ -578,17 +1001,12 @@ def find_children_by_relation(target_page_id: str) -> List[str]:
     """
     if not NOTION_DATABASE_ID:
         return []
-    calendar_pages = query_database_all(NOTION_DATABASE_ID, page_size=500)
-    children = []
-    for p in calendar_pages:
-        props_p = p.get("properties", {})
-        rel_key = find_prop_key(props_p, "Lịch G")
-        if not rel_key:
-            continue
-        rel_arr = props_p.get(rel_key, {}).get("relation", [])
-        if any(r.get("id") == target_page_id for r in rel_arr):
-            children.append(p.get("id"))
-    return children
+    # Lọc relation phía Notion → chỉ tải về các ngày của target, không kéo cả CALENDAR DB
+    pages, _ = _query_snapshot(
+        NOTION_DATABASE_ID,
+        filter={"property": "Lịch G", "relation": {"contains": target_page_id}},
+    )
+    return [p.get("id") for p in pages]
 
 
 # =====================================================================
@@ -635,23 +1053,22 @@ def dao_preview_text_from_props(title: str, props: dict):
                     f"🏛️ Tổng CK: ✅ {int(total_val):,}\n"
                     f"📆 Bắt đầu góp lại ngày mai ({restart})"
                 )
-                props["ONLY_LAI"] = True
                 return True, msg
 
             # --- NHÁNH CÓ LẤY TRƯỚC ---
             take_days = int(days_before)
             total_pre = int(per_day * take_days) if per_day else 0
             start = (datetime.now(VN_TZ)).date() + timedelta(days=1)
-            date_list = [(start + timedelta(days=i)).isoformat() for i in range(take_days)]
-            restart_date = (start + timedelta(days=take_days)).strftime("%d-%m-%Y")
+            base = start.toordinal()
+            date_list = [date.fromordinal(base + i) for i in range(take_days)]
+            restart_date = date.fromordinal(base + take_days).strftime("%d-%m-%Y")
 
             lines = [
                 f"🔔 {header_line}",
                 "",
                 f"💴 Lấy trước: {take_days} ngày {int(per_day):,} là {total_pre:,} ( từ ngày mai):",
             ]
-            for idx, d in enumerate(date_list, start=1):
-                lines.append(f"   {idx}. {d}")
+            lines.extend(f"   {idx}. {d}" for idx, d in enumerate(map(date.isoformat, date_list), start=1))
             lines.append("")
             lines.append(f"🔔 Đáo lại khách sẽ nhận : ✅ {int(total_val):,}")
             lines.append(f"📆 Đến ngày {restart_date} bắt đầu góp lại")
@@ -659,7 +1076,6 @@ def dao_preview_text_from_props(title: str, props: dict):
 
         # ========== KHÚC CUỐI: FALLBACK ==========
         msg = f"🔔 đáo lại cho: {title} - Tổng CK: {int(total_val)}\n\nKhông Lấy trước\n\nGửi /ok để chỉ tạo Lãi."
-        props["ONLY_LAI"] = True
         return True, msg
 
     except Exception as e:
@@ -669,7 +1085,38 @@ def dao_preview_text_from_props(title: str, props: dict):
 # =====================================================================
 #  ACTIONS: MARK / UNDO
 # =====================================================================
-def mark_pages_by_indices(chat_id: str, keyword: str,
+def _mark_one(page_id: str, cb_key: str) -> Tuple[bool, Any]:
+    NOTION_LIMITER.acquire()
+    return update_page_properties(page_id, {cb_key: {"checkbox": True}})
+
+
+def _archive_one(page_id: str) -> Tuple[bool, Any]:
+    NOTION_LIMITER.acquire()
+    return archive_page(page_id)
+
+
+def _unarchive_one(page_id: str) -> Tuple[bool, Any]:
+    NOTION_LIMITER.acquire()
+    return unarchive_page(page_id)
+
+
+def _uncheck_one(page_id: str, cb_key: str) -> Tuple[bool, Any]:
+    NOTION_LIMITER.acquire()
+    return update_checkbox(page_id, False, cb_key)
+
+
+def _notion_fanout(fn: Callable[..., Tuple[bool, Any]], page_ids: List[str], *args):
+    """Chạy fn(pid, *args) song song trên NOTION_POOL → yield (pid, ok, res) theo thứ tự xong."""
+    futures = {NOTION_POOL.submit(fn, pid, *args): pid for pid in page_ids}
+    for fut in as_completed(futures):
+        try:
+            ok, res = fut.result()
+        except Exception as e:
+            ok, res = False, str(e)
+        yield futures[fut], ok, res
+
+
+def mark_pages_by_indices(chat_id: int, keyword: str,
                           matches: List[Tuple[str, str, Optional[str], Dict[str, Any]]],
                           indices: List[int]) -> Dict[str, Any]:
     succeeded = []
@@ -677,38 +1124,37 @@ def mark_pages_by_indices(chat_id: str, keyword: str,
     if len(indices) == 1 and indices[0] > 1:
         n = indices[0]
         indices = list(range(1, min(n, len(matches)) + 1))
+    # Các page cùng 1 DB → cùng schema, chỉ cần dò key checkbox 1 lần
+    cb_key = None
+    jobs = []
     for idx in indices:
         if idx < 1 or idx > len(matches):
             failed.append((idx, "index out of range"))
             continue
         pid, title, date_iso, props = matches[idx - 1]
+        if cb_key is None:
+            cb_key = find_checkbox_key(props) or "Đã Góp"
+        jobs.append(((pid, title, date_iso), NOTION_POOL.submit(_mark_one, pid, cb_key)))
+    for item, fut in jobs:
         try:
-            cb_key = find_prop_key(props, "Đã Góp") or find_prop_key(props, "Sent") or find_prop_key(props, "Status")
-            update_props = {}
-            if cb_key:
-                update_props[cb_key] = {"checkbox": True}
-            else:
-                update_props["Đã Góp"] = {"checkbox": True}
-            ok, res = update_page_properties(pid, update_props)
+            ok, res = fut.result()
             if ok:
-                succeeded.append((pid, title, date_iso))
+                succeeded.append(item)
             else:
-                failed.append((pid, res))
+                failed.append((item[0], res))
         except Exception as e:
-            failed.append((pid, str(e)))
+            failed.append((item[0], str(e)))
     if succeeded:
-        undo_stack.setdefault(str(chat_id), []).append({"action": "mark", "pages": [p[0] for p in succeeded]})
+        undo_stack[chat_id].append({"action": "mark", "pages": [p[0] for p in succeeded], "cb_key": cb_key})
     return {"ok": len(failed) == 0, "succeeded": succeeded, "failed": failed}
 
 
-def undo_last(chat_id: str, count: int = 1):
-    chat_key = str(chat_id)
-
-    if not undo_stack.get(chat_key):
+def undo_last(chat_id: int, count: int = 1):
+    if not undo_stack.get(chat_id):
         send_telegram(chat_id, "❌ Không có hành động nào để hoàn tác.")
         return
 
-    log = undo_stack[chat_key].pop()
+    log = undo_stack[chat_id].pop()
     if not log:
         send_telegram(chat_id, "❌ Không có dữ liệu undo.")
         return
@@ -727,23 +1173,25 @@ def undo_last(chat_id: str, count: int = 1):
         message_id = msg.get("result", {}).get("message_id")
         undone = 0
         failed = 0
+        # key checkbox đã dò lúc mark (cùng DB → cùng schema), khỏi dò lại từng page
+        cb_key = log.get("cb_key") or "Đã Góp"
 
-        for idx, pid in enumerate(pages, start=1):
-            try:
-                if action == "mark":
-                    update_checkbox(pid, False)
-                elif action == "archive":
-                    unarchive_page(pid)
-                bar = int((idx / total) * 10)
-                progress = "█" * bar + "░" * (10 - bar)
-                icon = ["♻️", "🔄", "💫", "✨"][idx % 4]
-                edit_telegram_message(chat_id, message_id,
-                                      f"{icon} Hoàn tác {idx}/{total} [{progress}]")
-                undone += 1
-                time.sleep(0.3)
-            except Exception as e:
-                print("Undo lỗi:", e)
+        progress_edit = throttled_progress(lambda text: edit_telegram_message(chat_id, message_id, text))
+        if action == "mark":
+            results = _notion_fanout(_uncheck_one, pages, cb_key)
+        else:
+            results = _notion_fanout(_unarchive_one, pages)
+
+        for idx, (pid, ok, res) in enumerate(results, start=1):
+            if not ok:
+                logger.warning("undo %s failed for %s: %s", action, pid, res, extra={"chat_id": chat_id})
                 failed += 1
+                continue
+            undone += 1
+            bar = int((idx / total) * 10)
+            progress = "█" * bar + "░" * (10 - bar)
+            icon = ["♻️", "🔄", "💫", "✨"][idx % 4]
+            progress_edit(f"{icon} Hoàn tác {idx}/{total} [{progress}]", idx == total)
 
         final = f"✅ Hoàn tác {undone}/{total} mục"
         if failed:
@@ -759,23 +1207,14 @@ def undo_last(chat_id: str, count: int = 1):
 
         send_telegram(chat_id, "♻️ Đang hoàn tác đáo...")
 
-        for pid in created_pages:
-            try:
-                archive_page(pid)
-            except Exception as e:
-                print("Undo dao — delete created_page lỗi:", e)
-
-        if lai_page:
-            try:
-                archive_page(lai_page)
-            except Exception as e:
-                print("Undo dao — delete lai_page lỗi:", e)
+        to_delete = created_pages + ([lai_page] if lai_page else [])
+        for pid, ok, res in _notion_fanout(_archive_one, to_delete):
+            if not ok:
+                logger.warning("undo dao: delete created/lai page %s failed: %s", pid, res, extra={"chat_id": chat_id})
 
-        for pid in archived_pages:
-            try:
-                unarchive_page(pid)
-            except Exception as e:
-                print("Undo dao — restore old_day lỗi:", e)
+        for pid, ok, res in _notion_fanout(_unarchive_one, archived_pages):
+            if not ok:
+                logger.warning("undo dao: restore old day %s failed: %s", pid, res, extra={"chat_id": chat_id})
 
         send_telegram(chat_id, "✅ Hoàn tác đáo thành công.")
         return
@@ -796,7 +1235,7 @@ def undo_last(chat_id: str, count: int = 1):
 # =====================================================================
 #  ACTIONS: ARCHIVE
 # =====================================================================
-def handle_command_archive(chat_id: str, keyword: str, auto_confirm_all: bool = True) -> Dict[str, Any]:
+def handle_command_archive(chat_id: int, keyword: str, auto_confirm_all: bool = True) -> Dict[str, Any]:
     try:
         matches = find_matching_all_pages_in_db(NOTION_DATABASE_ID, keyword, limit=5000)
         total = len(matches)
@@ -806,22 +1245,26 @@ def handle_command_archive(chat_id: str, keyword: str, auto_confirm_all: bool =
             return {"ok": True, "deleted": [], "failed": []}
         deleted = []
         failed = []
-        for i, (pid, title, date_iso) in enumerate(matches, start=1):
+        futures = {NOTION_POOL.submit(_archive_one, pid): pid for pid, title, date_iso in matches}
+        for i, fut in enumerate(as_completed(futures), start=1):
+            pid = futures[fut]
             send_progress(chat_id, i, total, f"🗑️ Đang xóa {keyword}")
-            ok, msg_r = archive_page(pid)
+            try:
+                ok, msg_r = fut.result()
+            except Exception as e:
+                ok, msg_r = False, str(e)
             if ok:
                 deleted.append(pid)
             else:
                 failed.append((pid, msg_r))
-            time.sleep(PATCH_DELAY)
         send_telegram(chat_id, f"✅ Đã xóa xong {len(deleted)}/{total} mục của {keyword}.")
         if failed:
             send_telegram(chat_id, f"⚠️ Có {len(failed)} mục xóa lỗi, xem logs.")
         if deleted:
-            undo_stack.setdefault(str(chat_id), []).append({"action": "archive", "pages": deleted})
+            undo_stack[chat_id].append({"action": "archive", "pages": deleted})
         return {"ok": True, "deleted": deleted, "failed": failed}
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("handle_command_archive failed", extra={"chat_id": chat_id})
         send_telegram(chat_id, f"❌ Lỗi archive: {e}")
         return {"ok": False, "error": str(e)}
 
@@ -838,12 +1281,13 @@ def create_lai_page(chat_id: int, title: str, lai_amount: float, relation_id: st
             "ngày lai": {"date": {"start": today}},
             "Lịch G": {"relation": [{"id": relation_id}]}
         }
-        url = "https://api.notion.com/v1/pages"
+        url = NOTION_PAGES_URL
         body = {"parent": {"database_id": LA_NOTION_DATABASE_ID}, "properties": props_payload}
-        r = requests.post(url, headers=NOTION_HEADERS, json=body, timeout=15)
+        r = NOTION_SESSION.post(url, data=json_dumps_bytes(body), timeout=15)
         if r.status_code in (200, 201):
+            invalidate_db_cache(LA_NOTION_DATABASE_ID)
             send_telegram(chat_id, f"💰 Đã tạo Lãi cho {title}: {lai_amount:,.0f}")
-            return r.json().get("id")
+            return json_loads(r.content).get("id")
         else:
             send_telegram(chat_id, f"⚠️ Tạo Lãi lỗi: {r.status_code} - {r.text[:200]}")
             return None
@@ -896,26 +1340,20 @@ def dao_create_pages_from_props(chat_id: int, source_page_id: str, props: Dict[s
             else:
                 update(f"🧹 Đang xóa {total} ngày của '{title}' ...")
                 time.sleep(0.3)
+                progress_update = throttled_progress(update)
                 for idx, day_id in enumerate(children, start=1):
                     try:
-                        archive_page(day_id)
+                        _archive_one(day_id)
                     except Exception as e:
                         print(f"⚠️ Lỗi archive: {day_id} — {e}")
                     bar = int((idx / total) * 10)
                     progress = "█" * bar + "░" * (10 - bar)
-                    update(f"🧹 Xóa {idx}/{total} [{progress}]")
-                    time.sleep(0.28)
+                    progress_update(f"🧹 Xóa {idx}/{total} [{progress}]", idx == total)
                 update(f"✅ Đã xóa toàn bộ {total} ngày cũ của '{title}' 🎉")
                 time.sleep(0.4)
 
             # Tạo Lãi
-            lai_text = (
-                extract_prop_text(props, "Lai lịch g")
-                or extract_prop_text(props, "Lãi")
-                or extract_prop_text(props, "Lai")
-                or ""
-            )
-            lai_amt = parse_money_from_text(lai_text) or 0
+            lai_amt = _lai_amount(props)
             lai_page_id = None  # FIX #2: khởi tạo trước
 
             if LA_NOTION_DATABASE_ID and lai_amt > 0:
@@ -936,7 +1374,7 @@ def dao_create_pages_from_props(chat_id: int, source_page_id: str, props: Dict[s
 
             update("🎉 Hoàn thành đáo — KHÔNG LẤY TRƯỚC.")
 
-            undo_stack.setdefault(str(chat_id), []).append({
+            undo_stack[chat_id].append({
                 "action": "dao",
                 "archived_pages": children,
                 "created_pages": [],
@@ -969,15 +1407,15 @@ def dao_create_pages_from_props(chat_id: int, source_page_id: str, props: Dict[s
         else:
             update(f"🧹 Đang xóa {total} ngày của '{title}' ...")
             time.sleep(0.3)
+            progress_update = throttled_progress(update)
             for idx, day_id in enumerate(matched, start=1):
                 try:
-                    archive_page(day_id)
+                    _archive_one(day_id)
                 except Exception as e:
                     print(f"⚠️ Lỗi archive {day_id}: {e}")
                 bar = int((idx / total) * 10)
                 progress = "█" * bar + "░" * (10 - bar)
-                update(f"🧹 Xóa {idx}/{total} [{progress}]")
-                time.sleep(0.28)
+                progress_update(f"🧹 Xóa {idx}/{total} [{progress}]", idx == total)
             update(f"✅ Đã xóa {total} ngày cũ của '{title}'.")
             time.sleep(0.4)
 
@@ -989,8 +1427,10 @@ def dao_create_pages_from_props(chat_id: int, source_page_id: str, props: Dict[s
         time.sleep(0.4)
 
         created = []
+        progress_update = throttled_progress(update)
+        base = start_date.toordinal()
         for i in range(1, take_days + 1):
-            d = start_date + timedelta(days=i - 1)
+            d = date.fromordinal(base + i - 1)
             props_payload = {
                 "Name": {"title": [{"type": "text", "text": {"content": title}}]},
                 "Ngày Góp": {"date": {"start": d.isoformat()}},
@@ -999,14 +1439,15 @@ def dao_create_pages_from_props(chat_id: int, source_page_id: str, props: Dict[s
                 "Lịch G": {"relation": [{"id": source_page_id}]},
             }
             try:
-                r = requests.post(
-                    "https://api.notion.com/v1/pages",
-                    headers=NOTION_HEADERS,
-                    json={"parent": {"database_id": NOTION_DATABASE_ID}, "properties": props_payload},
+                NOTION_LIMITER.acquire()
+                r = NOTION_SESSION.post(
+                    NOTION_PAGES_URL,
+                    data=json_dumps_bytes({"parent": {"database_id": NOTION_DATABASE_ID}, "properties": props_payload}),
                     timeout=15
                 )
                 if r.status_code in (200, 201):
-                    created.append(r.json())
+                    invalidate_db_cache(NOTION_DATABASE_ID)
+                    created.append(json_loads(r.content))
                 else:
                     update(f"⚠️ Lỗi tạo ngày: {r.status_code}")
             except Exception as e:
@@ -1014,20 +1455,13 @@ def dao_create_pages_from_props(chat_id: int, source_page_id: str, props: Dict[s
 
             bar = int((i / take_days) * 10)
             progress = "█" * bar + "░" * (10 - bar)
-            update(f"📅 Tạo ngày {i}/{take_days} [{progress}] — {d.isoformat()}")
-            time.sleep(0.25)
+            progress_update(f"📅 Tạo ngày {i}/{take_days} [{progress}] — {d.isoformat()}", i == take_days)
 
         update(f"✅ Đã tạo {len(created)} ngày mới cho '{title}' 🎉")
         time.sleep(0.4)
 
         # Tạo Lãi
-        lai_text = (
-            extract_prop_text(props, "Lai lịch g")
-            or extract_prop_text(props, "Lãi")
-            or extract_prop_text(props, "Lai")
-            or ""
-        )
-        lai_amt = parse_money_from_text(lai_text) or 0
+        lai_amt = _lai_amount(props)
         lai_page_id = None
 
         if LA_NOTION_DATABASE_ID and lai_amt > 0:
@@ -1048,7 +1482,7 @@ def dao_create_pages_from_props(chat_id: int, source_page_id: str, props: Dict[s
         except Exception as e:
             send_telegram(chat_id, f"⚠️ Lỗi cập nhật Ngày Đáo (bỏ qua): {e}")
 
-        undo_stack.setdefault(str(chat_id), []).append({
+        undo_stack[chat_id].append({
             "action": "dao",
             "archived_pages": matched,
             "created_pages": [p.get("id") for p in created],
@@ -1057,45 +1491,42 @@ def dao_create_pages_from_props(chat_id: int, source_page_id: str, props: Dict[s
 
     except Exception as e:
         send_telegram(chat_id, f"❌ Lỗi tiến trình đáo: {e}")
-        traceback.print_exc()
+        logger.exception("dao_create_pages_from_props failed", extra={"chat_id": chat_id})
 
 
 # =====================================================================
 #  PENDING / SELECTION PROCESSING
 # =====================================================================
+_SELECTION_PART_RE = re.compile(r"(\d+)(?:\s*-\s*(\d+))?")
+
+
 def parse_user_selection_text(sel_text: str, found_len: int) -> List[int]:
     s = sel_text.strip().lower()
     if s in ("all", "tất cả", "tat ca"):
         return list(range(1, found_len + 1))
-    parts = s.split(",")
+    if s.isascii() and s.isdigit():
+        # Fast path: 1 số duy nhất (trường hợp thường gặp nhất)
+        n = int(s)
+        return list(range(1, n + 1)) if 1 < n <= found_len else [n]
     selected = []
-    for p in parts:
-        p = p.strip()
-        if "-" in p:
-            try:
-                a, b = p.split("-", 1)
-                a_i = int(a)
-                b_i = int(b)
-                for i in range(min(a_i, b_i), max(a_i, b_i) + 1):
-                    selected.append(i)
-            except Exception:
-                pass
+    for p in s.split(","):
+        m = _SELECTION_PART_RE.fullmatch(p.strip())
+        if not m:
+            continue
+        a_i = int(m.group(1))
+        if m.group(2) is not None:
+            b_i = int(m.group(2))
+            selected.extend(range(min(a_i, b_i), max(a_i, b_i) + 1))
+        elif a_i > 1 and found_len >= a_i:
+            selected.extend(range(1, a_i + 1))
         else:
-            try:
-                n = int(p)
-                if n > 1 and found_len >= n:
-                    selected.extend(list(range(1, n + 1)))
-                else:
-                    selected.append(n)
-            except Exception:
-                pass
-    selected = sorted(list(dict.fromkeys([i for i in selected if isinstance(i, int)])))
+            selected.append(a_i)
+    selected = sorted(set(selected))
     return selected
 
 
-def process_pending_selection_for_dao(chat_id: str, raw: str):
-    key = str(chat_id)
-    data = pending_confirm.get(key)
+def process_pending_selection_for_dao(chat_id: int, raw: str):
+    data = pending_confirm.get(chat_id)
 
     if not data:
         send_telegram(chat_id, "⚠️ Không có thao tác đáo nào đang chờ.")
@@ -1104,8 +1535,8 @@ def process_pending_selection_for_dao(chat_id: str, raw: str):
     # =========================================================
     # 1) CHỌN DANH SÁCH (dao_choose)
     # =========================================================
-    if data.get("type") == "dao_choose":
-        matches = data.get("matches", []) or []
+    if data.type == "dao_choose":
+        matches = data.matches
         indices = parse_user_selection_text(raw, len(matches))
 
         if not indices:
@@ -1140,21 +1571,24 @@ def process_pending_selection_for_dao(chat_id: str, raw: str):
         except Exception:
             timer_id = None
 
-        pending_confirm[key] = {
-            "type": "dao_confirm",
-            "targets": selected,
-            "preview_text": agg_preview,
-            "title": agg_title,
-            "expires": time.time() + WAIT_CONFIRM,
-            "timer_message_id": timer_id,
-        }
+        if take_pending(chat_id, data) is None:  # hết hạn trong lúc dựng preview
+            stop_waiting_animation(chat_id)
+            return
+        set_pending(chat_id, PendingAction(
+            type="dao_confirm",
+            targets=selected,
+            preview_text=agg_preview,
+            title=agg_title,
+            expires=time.time() + WAIT_CONFIRM,
+            timer_message_id=timer_id,
+        ))
         start_waiting_animation(chat_id, timer_id, WAIT_CONFIRM, interval=2.0, label="xác nhận đáo")
         return
 
     # =========================================================
     # 2) /OK HOẶC /CANCEL (dao_confirm)
     # =========================================================
-    if data.get("type") == "dao_confirm":
+    if data.type == "dao_confirm":
         token = (raw or "").strip().lower()
 
         if not token:
@@ -1163,7 +1597,7 @@ def process_pending_selection_for_dao(chat_id: str, raw: str):
 
         if token in ("/cancel", "cancel", "hủy", "huỷ", "huy"):
             stop_waiting_animation(chat_id)
-            pending_confirm.pop(key, None)
+            clear_pending(chat_id)
             send_telegram(chat_id, "❌ Đã hủy thao tác đáo.")
             return
 
@@ -1171,14 +1605,16 @@ def process_pending_selection_for_dao(chat_id: str, raw: str):
             send_telegram(chat_id, "⚠️ Gửi /ok để xác nhận hoặc /cancel để hủy.")
             return
 
-        # OK
+        # OK — nhận entry dưới lock trước khi chạy, sweeper không thể expire giữa chừng
+        if take_pending(chat_id, data) is None:
+            send_telegram(chat_id, "⏳ Thao tác chờ đã hết hạn.")
+            return
         stop_waiting_animation(chat_id)
 
-        targets = data.get("targets") or []
-        title_all = data.get("title") or ""
+        targets = data.targets
+        title_all = data.title
 
         if not targets:
-            pending_confirm.pop(key, None)
             send_telegram(chat_id, "⚠️ Không có dữ liệu để đáo.")
             return
 
@@ -1192,13 +1628,7 @@ def process_pending_selection_for_dao(chat_id: str, raw: str):
                 truoc_val = _num(props, "trước")
                 is_no_take = (truoc_val == 0)
 
-                lai_text = (
-                    extract_prop_text(props, "Lai lịch g")
-                    or extract_prop_text(props, "Lãi")
-                    or extract_prop_text(props, "Lai")
-                    or ""
-                )
-                lai_amt = parse_money_from_text(lai_text) or 0
+                lai_amt = _lai_amount(props)
 
                 # ========================
                 # CASE 1 — KHÔNG LẤY TRƯỚC
@@ -1226,12 +1656,12 @@ def process_pending_selection_for_dao(chat_id: str, raw: str):
                     else:
                         _update_no_take(f"🧹 Bắt đầu xóa {total} ngày ...")
                         time.sleep(0.25)
+                        progress_no_take = throttled_progress(_update_no_take)
                         for idx, day_id in enumerate(children, start=1):
-                            archive_page(day_id)
+                            _archive_one(day_id)
                             bar = int((idx / total) * 10)
                             progress = "█" * bar + "░" * (10 - bar)
-                            _update_no_take(f"🧹 Xóa {idx}/{total} [{progress}]")
-                            time.sleep(0.25)
+                            progress_no_take(f"🧹 Xóa {idx}/{total} [{progress}]", idx == total)
                         _update_no_take(f"✅ Đã xóa toàn bộ {total} ngày 🎉")
                         time.sleep(0.3)
 
@@ -1252,7 +1682,7 @@ def process_pending_selection_for_dao(chat_id: str, raw: str):
                         print(f"⚠️ Lỗi cập nhật Ngày Đáo cho {ttitle}: {e}")
 
                     # FIX #3: children là list string → dùng trực tiếp
-                    undo_stack.setdefault(str(chat_id), []).append({
+                    undo_stack[chat_id].append({
                         "action": "dao",
                         "archived_pages": children,
                         "created_pages": [],
@@ -1273,21 +1703,17 @@ def process_pending_selection_for_dao(chat_id: str, raw: str):
         ok_list = [r for r in results if r[2]]
         fail_list = [r for r in results if not r[2]]
 
-        text = f"🎉 Hoàn tất đáo cho: {title_all}\n"
-        text += f"✅ Thành công: {len(ok_list)}\n"
+        lines = [f"🎉 Hoàn tất đáo cho: {title_all}", f"✅ Thành công: {len(ok_list)}"]
         if fail_list:
-            text += f"⚠️ Lỗi: {len(fail_list)}\n"
-            for pid_, nm, ok_, er in fail_list:
-                text += f"- {nm}: {er}\n"
+            lines.append(f"⚠️ Lỗi: {len(fail_list)}")
+            lines.extend(f"- {nm}: {er}" for pid_, nm, ok_, er in fail_list)
 
-        send_telegram(chat_id, text)
-        pending_confirm.pop(key, None)
+        send_telegram(chat_id, "\n".join(lines) + "\n")
         return
 
 
-def process_pending_selection(chat_id: str, raw: str):
-    key = str(chat_id)
-    data = pending_confirm.get(key)
+def process_pending_selection(chat_id: int, raw: str):
+    data = pending_confirm.get(chat_id)
 
     if not data:
         send_telegram(chat_id, "❌ Không có thao tác nào đang chờ.")
@@ -1298,14 +1724,14 @@ def process_pending_selection(chat_id: str, raw: str):
 
         if raw_input in ("/cancel", "cancel", "hủy", "huỷ", "huy"):
             stop_waiting_animation(chat_id)
-            pending_confirm.pop(key, None)
+            clear_pending(chat_id)
             send_telegram(chat_id, "🛑 Đã hủy thao tác đang chờ.")
             return
 
-        matches = data.get("matches", [])
+        matches = data.matches
         if not matches:
             send_telegram(chat_id, "⚠️ Không tìm thấy danh sách mục đang xử lý.")
-            pending_confirm.pop(key, None)
+            clear_pending(chat_id)
             return
 
         indices = parse_user_selection_text(raw_input, len(matches))
@@ -1313,25 +1739,32 @@ def process_pending_selection(chat_id: str, raw: str):
             send_telegram(chat_id, "⚠️ Không nhận được lựa chọn hợp lệ.")
             return
 
-        action = data.get("type")
+        # Lựa chọn hợp lệ → nhận entry dưới lock; sweeper lấy trước thì dừng
+        if take_pending(chat_id, data) is None:
+            send_telegram(chat_id, "⏳ Thao tác chờ đã hết hạn.")
+            return
+        action = data.type
 
         # ======= ARCHIVE MODE =======
         if action == "archive_select":
             stop_waiting_animation(chat_id)
-            selected = [matches[i - 1] for i in indices if 1 <= i <= len(matches)]
+            n = len(matches)
+            selected = [matches[i - 1] for i in indices if 1 <= i <= n]
             total_sel = len(selected)
             if total_sel == 0:
                 send_telegram(chat_id, "⚠️ Không có mục nào được chọn để xóa.")
-                pending_confirm.pop(key, None)
                 return
 
-            msg_r = send_telegram(chat_id, f"🧹 Bắt đầu xóa {total_sel} mục của '{data['keyword']}' ...")
+            msg_r = send_telegram(chat_id, f"🧹 Bắt đầu xóa {total_sel} mục của '{data.keyword}' ...")
             message_id = msg_r.get("result", {}).get("message_id")
 
             deleted = []
-            for idx, (pid, title, date_iso, props) in enumerate(selected, start=1):
+            progress_edit = throttled_progress(lambda text: edit_telegram_message(chat_id, message_id, text))
+            futures = {NOTION_POOL.submit(_archive_one, pid): (pid, title) for pid, title, date_iso, props in selected}
+            for idx, fut in enumerate(as_completed(futures), start=1):
+                pid, title = futures[fut]
                 try:
-                    ok, res = archive_page(pid)
+                    ok, res = fut.result()
                     if not ok:
                         send_telegram(chat_id, f"⚠️ Lỗi khi xóa {title}: {res}")
                         continue
@@ -1339,53 +1772,54 @@ def process_pending_selection(chat_id: str, raw: str):
                     bar = int((idx / total_sel) * 10)
                     progress = "█" * bar + "░" * (10 - bar)
                     percent = int((idx / total_sel) * 100)
-                    edit_telegram_message(chat_id, message_id, f"🧹 Xóa {idx}/{total_sel} [{progress}] {percent}%")
-                    time.sleep(0.4)
+                    progress_edit(f"🧹 Xóa {idx}/{total_sel} [{progress}] {percent}%", idx == total_sel)
                 except Exception as e:
                     send_telegram(chat_id, f"⚠️ Lỗi khi xóa {idx}/{total_sel}: {e}")
 
             edit_telegram_message(
                 chat_id, message_id,
-                f"✅ Hoàn tất xóa {total_sel}/{total_sel} mục của '{data['keyword']}' 🎉"
+                f"✅ Hoàn tất xóa {total_sel}/{total_sel} mục của '{data.keyword}' 🎉"
             )
             if deleted:
-                undo_stack.setdefault(str(chat_id), []).append({"action": "archive", "pages": deleted})
-            pending_confirm.pop(key, None)
+                undo_stack[chat_id].append({"action": "archive", "pages": deleted})
             return
 
         # ======= MARK MODE =======
         if action == "mark":
             stop_waiting_animation(chat_id)
-            keyword = data.get("keyword")
+            keyword = data.keyword
             total_sel = len(indices)
             msg_r = send_telegram(chat_id, f"🟢 Bắt đầu đánh dấu {total_sel} mục cho '{keyword}' ...")
             message_id = msg_r.get("result", {}).get("message_id")
 
             succeeded, failed = [], []
+            cb_key = None
+            futures = {}
+            progress_edit = throttled_progress(lambda text: edit_telegram_message(chat_id, message_id, text))
 
             for idx in indices:
                 if 1 <= idx <= len(matches):
                     pid, title, date_iso, props = matches[idx - 1]
-                    try:
-                        cb_key = (
-                            find_prop_key(props, "Đã Góp")
-                            or find_prop_key(props, "Sent")
-                            or find_prop_key(props, "Status")
-                        )
-                        update_props = {cb_key or "Đã Góp": {"checkbox": True}}
-                        ok, res = update_page_properties(pid, update_props)
-                        if ok:
-                            succeeded.append((pid, title))
-                            bar = int((len(succeeded) / total_sel) * 10)
-                            progress = "█" * bar + "░" * (10 - bar)
-                            percent = int((len(succeeded) / total_sel) * 100)
-                            edit_telegram_message(chat_id, message_id,
-                                                  f"🟢 Đánh dấu {len(succeeded)}/{total_sel} [{progress}] {percent}%")
-                        else:
-                            failed.append((pid, res))
-                    except Exception as e:
-                        failed.append((pid, str(e)))
-                    time.sleep(0.3)
+                    if cb_key is None:
+                        cb_key = find_checkbox_key(props) or "Đã Góp"
+                    futures[NOTION_POOL.submit(_mark_one, pid, cb_key)] = (pid, title)
+
+            # Progress cập nhật theo thứ tự hoàn thành, từ thread hiện tại
+            for fut in as_completed(futures):
+                pid, title = futures[fut]
+                try:
+                    ok, res = fut.result()
+                    if ok:
+                        succeeded.append((pid, title))
+                        bar = int((len(succeeded) / total_sel) * 10)
+                        progress = "█" * bar + "░" * (10 - bar)
+                        percent = int((len(succeeded) / total_sel) * 100)
+                        progress_edit(f"🟢 Đánh dấu {len(succeeded)}/{total_sel} [{progress}] {percent}%",
+                                      len(succeeded) == total_sel)
+                    else:
+                        failed.append((pid, res))
+                except Exception as e:
+                    failed.append((pid, str(e)))
 
             result_text = f"✅ Hoàn tất đánh dấu {len(succeeded)}/{total_sel} mục 🎉"
             if failed:
@@ -1397,23 +1831,21 @@ def process_pending_selection(chat_id: str, raw: str):
                 send_telegram(chat_id, result_text)
 
             if succeeded:
-                undo_stack.setdefault(str(chat_id), []).append({"action": "mark", "pages": [p[0] for p in succeeded]})
+                undo_stack[chat_id].append({"action": "mark", "pages": [p[0] for p in succeeded], "cb_key": cb_key})
 
             # Tính count từ data cũ — không query lại
             n_ok = len(succeeded)
-            old_checked = data.get("checked", 0)
-            old_unchecked = data.get("unchecked", 0)
+            old_checked = data.checked
+            old_unchecked = data.unchecked
             send_telegram(chat_id, f"💴 {keyword}\n\n📊 Đã góp: {old_checked + n_ok}\n🟡 Chưa góp: {old_unchecked - n_ok}")
-            pending_confirm.pop(key, None)
             return
 
         send_telegram(chat_id, "⚠️ Không xác định được loại thao tác. Vui lòng thử lại.")
-        pending_confirm.pop(key, None)
 
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("process_pending_selection failed", extra={"chat_id": chat_id})
         send_telegram(chat_id, f"❌ Lỗi xử lý lựa chọn: {e}")
-        pending_confirm.pop(key, None)
+        clear_pending(chat_id)
 
 
 # =====================================================================
@@ -1448,7 +1880,8 @@ def preview_switch_on(chat_id: int, keyword: str):
             return
 
         start_date = datetime.now(VN_TZ).date()
-        days = [start_date + timedelta(days=i) for i in range(take_days)]
+        base = start_date.toordinal()
+        days = [date.fromordinal(base + i) for i in range(take_days)]
         next_start = (start_date + timedelta(days=take_days)).strftime("%d-%m-%Y")
 
         lines = [
@@ -1468,18 +1901,18 @@ def preview_switch_on(chat_id: int, keyword: str):
         timer_msg = send_telegram(chat_id, f"⏳ Đang chờ xác nhận trong {WAIT_CONFIRM}s...")
         timer_message_id = timer_msg.get("result", {}).get("message_id")
 
-        pending_confirm[str(chat_id)] = {
-            "type": "switch_on_confirm",
-            "target_id": target_id,
-            "title": title,
-            "props": props,
-            "expires": time.time() + WAIT_CONFIRM,
-            "timer_message_id": timer_message_id,
-        }
+        set_pending(chat_id, PendingAction(
+            type="switch_on_confirm",
+            target_id=target_id,
+            title=title,
+            props=props,
+            expires=time.time() + WAIT_CONFIRM,
+            timer_message_id=timer_message_id,
+        ))
         start_waiting_animation(chat_id, timer_message_id, WAIT_CONFIRM, interval=2.0, label="xác nhận ON")
 
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("preview_switch_on failed", extra={"chat_id": chat_id})
         send_telegram(chat_id, f"❌ Lỗi preview ON: {e}")
 
 
@@ -1504,13 +1937,7 @@ def preview_switch_off(chat_id: int, keyword: str):
         total_days = len(children)
 
         # Đọc Lãi
-        lai_text = (
-            extract_prop_text(props, "Lai lịch g")
-            or extract_prop_text(props, "Lãi")
-            or extract_prop_text(props, "Lai")
-            or ""
-        )
-        lai_amt = parse_money_from_text(lai_text) or 0
+        lai_amt = _lai_amount(props)
 
         lines = [
             f"🔴 Tắt OFF cho: {title}",
@@ -1528,26 +1955,25 @@ def preview_switch_off(chat_id: int, keyword: str):
         timer_msg = send_telegram(chat_id, f"⏳ Đang chờ xác nhận trong {WAIT_CONFIRM}s...")
         timer_message_id = timer_msg.get("result", {}).get("message_id")
 
-        pending_confirm[str(chat_id)] = {
-            "type": "switch_off_confirm",
-            "target_id": target_id,
-            "title": title,
-            "props": props,
-            "children": children,
-            "expires": time.time() + WAIT_CONFIRM,
-            "timer_message_id": timer_message_id,
-        }
+        set_pending(chat_id, PendingAction(
+            type="switch_off_confirm",
+            target_id=target_id,
+            title=title,
+            props=props,
+            children=children,
+            expires=time.time() + WAIT_CONFIRM,
+            timer_message_id=timer_message_id,
+        ))
         start_waiting_animation(chat_id, timer_message_id, WAIT_CONFIRM, interval=2.0, label="xác nhận OFF")
 
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("preview_switch_off failed", extra={"chat_id": chat_id})
         send_telegram(chat_id, f"❌ Lỗi preview OFF: {e}")
 
 
 def process_pending_switch(chat_id: int, raw: str):
     """Xử lý /ok hoặc /cancel cho switch ON/OFF"""
-    key = str(chat_id)
-    data = pending_confirm.get(key)
+    data = pending_confirm.get(chat_id)
 
     if not data:
         send_telegram(chat_id, "⚠️ Không có thao tác ON/OFF nào đang chờ.")
@@ -1558,7 +1984,7 @@ def process_pending_switch(chat_id: int, raw: str):
     # --- CANCEL ---
     if token in ("/cancel", "cancel", "hủy", "huỷ", "huy"):
         stop_waiting_animation(chat_id)
-        pending_confirm.pop(key, None)
+        clear_pending(chat_id)
         send_telegram(chat_id, "❌ Đã hủy thao tác ON/OFF.")
         return
 
@@ -1568,29 +1994,29 @@ def process_pending_switch(chat_id: int, raw: str):
         return
 
     # --- OK ---
+    if take_pending(chat_id, data) is None:
+        send_telegram(chat_id, "⏳ Thao tác chờ đã hết hạn.")
+        return
     stop_waiting_animation(chat_id)
-    ptype = data.get("type")
+    ptype = data.type
 
     if ptype == "switch_on_confirm":
-        pending_confirm.pop(key, None)
         execute_switch_on(
             chat_id,
-            data.get("target_id"),
-            data.get("title"),
-            data.get("props", {}),
+            data.target_id,
+            data.title,
+            data.props,
         )
     elif ptype == "switch_off_confirm":
-        pending_confirm.pop(key, None)
         execute_switch_off(
             chat_id,
-            data.get("target_id"),
-            data.get("title"),
-            data.get("props", {}),
-            data.get("children", []),
+            data.target_id,
+            data.title,
+            data.props,
+            data.children,
         )
     else:
         send_telegram(chat_id, f"⚠️ Không xác định được loại thao tác: {ptype}")
-        pending_confirm.pop(key, None)
 
 
 def execute_switch_on(chat_id: int, target_id: str, title: str, props: dict):
@@ -1663,8 +2089,10 @@ def execute_switch_on(chat_id: int, target_id: str, title: str, props: dict):
         time.sleep(0.3)
 
         start_date = datetime.now(VN_TZ).date()
-        days = [start_date + timedelta(days=i) for i in range(take_days)]
+        base = start_date.toordinal()
+        days = [date.fromordinal(base + i) for i in range(take_days)]
         created_pages = []
+        progress_update = throttled_progress(update)
 
         for idx, d in enumerate(days, start=1):
             props_payload = {
@@ -1674,6 +2102,7 @@ def execute_switch_on(chat_id: int, target_id: str, title: str, props: dict):
                 "Đã Góp": {"checkbox": True},
                 "Lịch G": {"relation": [{"id": target_id}]}
             }
+            NOTION_LIMITER.acquire()
             ok, res = create_page_in_db(NOTION_DATABASE_ID, props_payload)
             if ok:
                 created_pages.append(res.get("id"))
@@ -1682,8 +2111,7 @@ def execute_switch_on(chat_id: int, target_id: str, title: str, props: dict):
 
             bar = int((idx / take_days) * 10)
             progress = "▬" * bar + "▭" * (10 - bar)
-            update(f"📅 Tạo ngày {idx}/{take_days} [{progress}] – {d.isoformat()}")
-            time.sleep(0.25)
+            progress_update(f"📅 Tạo ngày {idx}/{take_days} [{progress}] – {d.isoformat()}", idx == take_days)
 
         update(f"✅ Đã tạo {len(created_pages)} ngày mới cho '{title}' 🎉")
         time.sleep(0.4)
@@ -1706,7 +2134,7 @@ def execute_switch_on(chat_id: int, target_id: str, title: str, props: dict):
         update("\n".join(lines))
 
         # Ghi undo log
-        undo_stack.setdefault(str(chat_id), []).append({
+        undo_stack[chat_id].append({
             "action": "switch_on",
             "target_id": target_id,
             "title": title,
@@ -1717,7 +2145,7 @@ def execute_switch_on(chat_id: int, target_id: str, title: str, props: dict):
         })
 
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("execute_switch_on failed", extra={"chat_id": chat_id})
         send_telegram(chat_id, f"❌ Lỗi ON: {e}")
 
 
@@ -1745,23 +2173,17 @@ def execute_switch_off(chat_id: int, target_id: str, title: str, props: dict, ch
         else:
             update(f"🧹 Bắt đầu xóa {total} ngày ...")
             time.sleep(0.3)
+            progress_update = throttled_progress(update)
             for idx, day_id in enumerate(children, start=1):
-                archive_page(day_id)
+                _archive_one(day_id)
                 bar = int((idx / total) * 10)
                 progress = "▬" * bar + "▭" * (10 - bar)
-                update(f"🧹 Xóa {idx}/{total} [{progress}]")
-                time.sleep(0.25)
+                progress_update(f"🧹 Xóa {idx}/{total} [{progress}]", idx == total)
             update(f"✅ Đã xóa toàn bộ {total} ngày 🎉")
             time.sleep(0.4)
 
         # Tạo Lãi
-        lai_text = (
-            extract_prop_text(props, "Lai lịch g")
-            or extract_prop_text(props, "Lãi")
-            or extract_prop_text(props, "Lai")
-            or ""
-        )
-        lai_amt = parse_money_from_text(lai_text) or 0
+        lai_amt = _lai_amount(props)
         lai_page_id = None
 
         if lai_amt > 0:
@@ -1815,7 +2237,7 @@ def execute_switch_off(chat_id: int, target_id: str, title: str, props: dict, ch
         update(f"🎉 Hoàn tất OFF cho: {title}")
 
         # Ghi undo log
-        undo_stack.setdefault(str(chat_id), []).append({
+        undo_stack[chat_id].append({
             "action": "switch_off",
             "target_id": target_id,
             "title": title,
@@ -1827,7 +2249,7 @@ def execute_switch_off(chat_id: int, target_id: str, title: str, props: dict, ch
         })
 
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("execute_switch_off failed", extra={"chat_id": chat_id})
         send_telegram(chat_id, f"❌ Lỗi OFF: {e}")
 
 
@@ -1841,17 +2263,14 @@ def _undo_switch_on(chat_id: int, log: dict):
     created = log.get("created_pages", [])
     total = len(created)
 
-    for idx, pid in enumerate(created, start=1):
-        try:
-            archive_page(pid)
-            bar = int((idx / total) * 10) if total > 0 else 0
-            progress = "▬" * bar + "▭" * (10 - bar)
-            if message_id:
-                edit_telegram_message(chat_id, message_id,
-                                      f"♻️ Xóa ngày {idx}/{total} [{progress}]")
-            time.sleep(0.25)
-        except Exception as e:
-            print(f"⚠️ Lỗi xóa page: {pid} – {e}")
+    progress_edit = throttled_progress(lambda text: edit_telegram_message(chat_id, message_id, text))
+    for idx, (pid, ok, res) in enumerate(_notion_fanout(_archive_one, created), start=1):
+        if not ok:
+            logger.warning("undo switch_on: archive %s failed: %s", pid, res, extra={"chat_id": chat_id})
+            continue
+        bar = int((idx / total) * 10) if total > 0 else 0
+        progress = "▬" * bar + "▭" * (10 - bar)
+        progress_edit(f"♻️ Xóa ngày {idx}/{total} [{progress}]", idx == total)
 
     target_id = log.get("target_id")
     old_tt = log.get("old_trangthai")
@@ -1888,17 +2307,14 @@ def _undo_switch_off(chat_id: int, log: dict):
     archived = log.get("archived_pages", [])
     total = len(archived)
 
-    for idx, pid in enumerate(archived, start=1):
-        try:
-            unarchive_page(pid)
-            bar = int((idx / total) * 10) if total > 0 else 0
-            progress = "▬" * bar + "▭" * (10 - bar)
-            if message_id:
-                edit_telegram_message(chat_id, message_id,
-                                      f"♻️ Khôi phục {idx}/{total} [{progress}]")
-            time.sleep(0.25)
-        except Exception as e:
-            print(f"⚠️ Lỗi khôi phục page: {pid} – {e}")
+    progress_edit = throttled_progress(lambda text: edit_telegram_message(chat_id, message_id, text))
+    for idx, (pid, ok, res) in enumerate(_notion_fanout(_unarchive_one, archived), start=1):
+        if not ok:
+            logger.warning("undo switch_off: unarchive %s failed: %s", pid, res, extra={"chat_id": chat_id})
+            continue
+        bar = int((idx / total) * 10) if total > 0 else 0
+        progress = "▬" * bar + "▭" * (10 - bar)
+        progress_edit(f"♻️ Khôi phục {idx}/{total} [{progress}]", idx == total)
 
     lai_page = log.get("lai_page")
     if lai_page:
@@ -1938,6 +2354,11 @@ def _undo_switch_off(chat_id: int, log: dict):
 # =====================================================================
 #  COMMAND PARSING & MAIN HANDLER
 # =====================================================================
+_ARCHIVE_WORD_RE = re.compile(r"xóa|archive|del")  # "delete" đã chứa "del"
+_DAO_WORD_RE = re.compile(r"đáo|dao|daó")  # "đáo hạn" đã chứa "đáo"
+
+
+@lru_cache(maxsize=2048)  # hàm thuần, trả tuple bất biến → cache an toàn
 def parse_user_command(raw: str) -> Tuple[str, int, Optional[str]]:
     raw = raw.strip()
     if not raw:
@@ -1947,36 +2368,66 @@ def parse_user_command(raw: str) -> Tuple[str, int, Optional[str]]:
     kw = parts[0]
     count = 0
     action = None
+    low = raw.lower()
 
     if len(parts) > 1 and parts[1].isdigit():
         count = int(parts[1])
         action = "mark"
-    elif raw.lower() in ("undo", "/undo"):
+    elif low in ("undo", "/undo"):
         action = "undo"
-    elif any(x in raw.lower() for x in ["xóa", "archive", "del", "delete"]):
+    elif _ARCHIVE_WORD_RE.search(low):
         action = "archive"
-    elif any(x in raw.lower() for x in ["đáo", "dao", "daó", "đáo hạn"]):
+    elif _DAO_WORD_RE.search(low):
         action = "dao"
 
     return kw, count, action
 
 
-def handle_incoming_message(chat_id: int, text: str):
+def is_allowed_chat(chat_id: int) -> bool:
+    """Chat lạ → bỏ qua im lặng (không tốn request Telegram cho update rác)."""
+    return _ALLOWED_CHAT is None or str(chat_id) == _ALLOWED_CHAT
+
+
+def quick_reply_text(chat_id: int, text: str) -> Optional[str]:
+    """Các câu trả lời không cần gọi Notion (tin rỗng, /cancel khi không có pending)."""
+    low = text.strip().lower()
+    if not low:
+        return "Vui lòng gửi lệnh hoặc từ khoá."
+    if low in ("/cancel", "cancel", "hủy", "huy") and chat_id not in pending_confirm:
+        stop_waiting_animation(chat_id)
+        return "Không có thao tác đang chờ. /cancel ignored."
+    return None
+
+
+# pending type → (handler, thông báo khi handler lỗi)
+PENDING_HANDLERS = {
+    "dao_choose": (process_pending_selection_for_dao, "❌ Lỗi khi xử lý thao tác đang chờ."),
+    "dao_confirm": (process_pending_selection_for_dao, "❌ Lỗi khi xử lý thao tác đang chờ."),
+    "switch_on_confirm": (process_pending_switch, "❌ Lỗi khi xử lý thao tác ON/OFF đang chờ."),
+    "switch_off_confirm": (process_pending_switch, "❌ Lỗi khi xử lý thao tác ON/OFF đang chờ."),
+}
+
+
+def handle_incoming_message(chat_id: int, text: str, received_at: Optional[float] = None):
+    chat_id = int(chat_id)  # mọi dict state (pending / undo / animation) đều key theo int
+    if not is_allowed_chat(chat_id):
+        return
     try:
         matches = []
         kw = ""
 
-        if TELEGRAM_CHAT_ID and str(chat_id) != str(TELEGRAM_CHAT_ID):
-            send_telegram(chat_id, "Bot chưa được phép nhận lệnh từ chat này.")
+        reply = quick_reply_text(chat_id, text)
+        if reply:
+            send_telegram(chat_id, reply)
             return
 
         raw = text.strip()
-        if not raw:
-            send_telegram(chat_id, "Vui lòng gửi lệnh hoặc từ khoá.")
-            return
-
         low = raw.lower()
 
+        if is_repeated_command(chat_id, raw, received_at):
+            logger.warning("bỏ lệnh lặp trong %ss: %r", COMMAND_DEBOUNCE, raw, extra={"chat_id": chat_id})
+            return
+
         # ===== DEBUG COMMAND =====
         if low.startswith("debug "):
             debug_kw = raw[6:].strip()
@@ -2055,9 +2506,9 @@ def handle_incoming_message(chat_id: int, text: str):
 
                     # 5. Thử GET page trực tiếp để xem full relation config
                     try:
-                        r = requests.get(
-                            f"https://api.notion.com/v1/pages/{target_id}/properties/{ttd_key}",
-                            headers=NOTION_HEADERS, timeout=15
+                        r = NOTION_SESSION.get(
+                            f"{_page_url(target_id)}/properties/{ttd_key}",
+                            timeout=15
                         )
                         lines.append(f"\n📡 GET property API: status={r.status_code}")
                         lines.append(f"  response: {r.text[:300]}")
@@ -2095,71 +2546,36 @@ def handle_incoming_message(chat_id: int, text: str):
 
             except Exception as e:
                 lines.append(f"❌ Lỗi: {e}")
-                traceback.print_exc()
+                logger.exception("debug ttd failed", extra={"chat_id": chat_id})
 
             # Chia nhỏ nếu quá dài
             msg_text = "\n".join(lines)
-            if len(msg_text) > 3500:
+            if len(msg_text) > TELEGRAM_MAX_TEXT:
                 send_long_text(chat_id, msg_text)
             else:
                 send_telegram(chat_id, msg_text)
             return
 
-        # Route pending DAO
-        _pending = pending_confirm.get(str(chat_id))
-        if _pending and isinstance(raw, str) and _pending.get("type", "").startswith("dao_"):
-            try:
-                process_pending_selection_for_dao(chat_id, raw)
-            except Exception:
-                traceback.print_exc()
-                send_telegram(chat_id, "❌ Lỗi khi xử lý thao tác đang chờ.")
-            return
-
-        # Route pending SWITCH ON/OFF confirm
-        if _pending and isinstance(raw, str) and _pending.get("type", "").startswith("switch_"):
-            try:
-                process_pending_switch(chat_id, raw)
-            except Exception:
-                traceback.print_exc()
-                send_telegram(chat_id, "❌ Lỗi khi xử lý thao tác ON/OFF đang chờ.")
-            return
+        # Route pending theo type: dao_* / switch_* xử lý ngay, còn lại (mark / archive) đẩy vào EXECUTOR
+        pc = pending_confirm.get(chat_id)
+        if pc:
+            route = PENDING_HANDLERS.get(pc.type)
+            if route:
+                handler, err_text = route
+                try:
+                    handler(chat_id, raw)
+                except Exception:
+                    logger.exception("pending handler %s failed", pc.type, extra={"chat_id": chat_id})
+                    send_telegram(chat_id, err_text)
+                return
 
-        # Pending confirm (mark / archive)
-        if str(chat_id) in pending_confirm:
             if low in ("/cancel", "cancel", "hủy", "huy"):
                 stop_waiting_animation(chat_id)
-                pending_confirm.pop(str(chat_id), None)
+                clear_pending(chat_id)
                 send_telegram(chat_id, "Đã hủy thao tác đang chờ.")
                 return
 
-            pc = pending_confirm[str(chat_id)]
-            if pc.get("type") in ("dao_choose", "dao_confirm"):
-                threading.Thread(
-                    target=process_pending_selection_for_dao,
-                    args=(chat_id, raw),
-                    daemon=True
-                ).start()
-                return
-
-            if pc.get("type") in ("switch_on_confirm", "switch_off_confirm"):
-                threading.Thread(
-                    target=process_pending_switch,
-                    args=(chat_id, raw),
-                    daemon=True
-                ).start()
-                return
-
-            threading.Thread(
-                target=process_pending_selection,
-                args=(chat_id, raw),
-                daemon=True
-            ).start()
-            return
-
-        # Cancel khi không có pending
-        if low in ("/cancel", "cancel", "hủy", "huy"):
-            stop_waiting_animation(chat_id)
-            send_telegram(chat_id, "Không có thao tác đang chờ. /cancel ignored.")
+            submit_task(process_pending_selection, chat_id, raw)
             return
 
         # Phân tích lệnh
@@ -2169,19 +2585,11 @@ def handle_incoming_message(chat_id: int, text: str):
 
         # ===== SWITCH ON / OFF → PREVIEW + CHỜ /OK =====
         if low_raw.endswith(" on"):
-            threading.Thread(
-                target=preview_switch_on,
-                args=(chat_id, kw),
-                daemon=True
-            ).start()
+            submit_task(preview_switch_on, chat_id, kw)
             return
 
         if low_raw.endswith(" off"):
-            threading.Thread(
-                target=preview_switch_off,
-                args=(chat_id, kw),
-                daemon=True
-            ).start()
+            submit_task(preview_switch_off, chat_id, kw)
             return
 
         # --- AUTO-MARK ---
@@ -2197,11 +2605,10 @@ def handle_incoming_message(chat_id: int, text: str):
             res = mark_pages_by_indices(chat_id, kw, matches, selected_indices)
 
             if res.get("succeeded"):
-                txt = "✅ ngày mới góp 📆:\n"
-                for pid, title, date_iso in res["succeeded"]:
-                    ds = date_iso[:10] if date_iso else "-"
-                    txt += f"{ds} — {title}\n"
-                send_long_text(chat_id, txt)
+                lines = ["✅ ngày mới góp 📆:"]
+                lines.extend(f"{date_iso[:10] if date_iso else '-'} — {title}"
+                             for pid, title, date_iso in res["succeeded"])
+                send_long_text(chat_id, "\n".join(lines) + "\n")
 
             if res.get("failed"):
                 send_telegram(chat_id, f"⚠️ Có {len(res['failed'])} mục đánh dấu lỗi.")
@@ -2216,11 +2623,7 @@ def handle_incoming_message(chat_id: int, text: str):
         # --- UNDO ---
         if action == "undo":
             send_telegram(chat_id, "♻️ Đang hoàn tác hành động gần nhất ...")
-            threading.Thread(
-                target=undo_last,
-                args=(chat_id, 1),
-                daemon=True
-            ).start()
+            submit_task(undo_last, chat_id, 1)
             return
 
         # --- ARCHIVE ---
@@ -2228,24 +2631,16 @@ def handle_incoming_message(chat_id: int, text: str):
             send_telegram(chat_id, f"🗑️đang tìm để xóa ⏳...{kw} ")
 
             kw_norm = normalize_text(keyword)
-            pages = query_database_all(NOTION_DATABASE_ID, page_size=MAX_QUERY_PAGE_SIZE)
             matches = []
 
-            for p in pages:
-                props = p.get("properties", {})
-                title = extract_prop_text(props, "Name") or extract_prop_text(props, "Title") or ""
-                if not title:
-                    continue
-                if not _match_keyword_to_title(kw_norm, title):
-                    continue
-
+            for pid, title, title_clean, tokens, gcodes, props in search_title_index(NOTION_DATABASE_ID, kw_norm):
                 date_key = find_prop_key(props, "Ngày Góp") or find_prop_key(props, "Date")
                 date_iso = None
                 if date_key:
                     df = props.get(date_key, {}).get("date")
                     if df:
                         date_iso = df.get("start")
-                matches.append((p.get("id"), title, date_iso, props))
+                matches.append((pid, title, date_iso, props))
 
             matches.sort(key=lambda x: (x[2] is None, x[2] or ""), reverse=True)
 
@@ -2254,10 +2649,8 @@ def handle_incoming_message(chat_id: int, text: str):
                 return
 
             header = f"🗑️ Chọn mục cần xóa cho '{kw}':\n\n"
-            lines = []
-            for i, (pid, title, date_iso, props) in enumerate(matches, start=1):
-                ds = date_iso[:10] if date_iso else "-"
-                lines.append(f"{i}. [{ds}] {title}")
+            lines = [f"{i}. [{date_iso[:10] if date_iso else '-'}] {title}"
+                     for i, (pid, title, date_iso, props) in enumerate(matches, start=1)]
 
             send_telegram(chat_id, header + "\n".join(lines))
 
@@ -2267,13 +2660,13 @@ def handle_incoming_message(chat_id: int, text: str):
             )
             timer_message_id = timer_msg.get("result", {}).get("message_id")
 
-            pending_confirm[str(chat_id)] = {
-                "type": "archive_select",
-                "keyword": kw,
-                "matches": matches,
-                "expires": time.time() + WAIT_CONFIRM,
-                "timer_message_id": timer_message_id
-            }
+            set_pending(chat_id, PendingAction(
+                type="archive_select",
+                keyword=kw,
+                matches=matches,
+                expires=time.time() + WAIT_CONFIRM,
+                timer_message_id=timer_message_id
+            ))
             start_waiting_animation(chat_id, timer_message_id, WAIT_CONFIRM, interval=2.0, label="chọn mục xóa")
             return
 
@@ -2305,12 +2698,12 @@ def handle_incoming_message(chat_id: int, text: str):
                 )
                 timer_message_id = timer_msg.get("result", {}).get("message_id")
 
-                pending_confirm[str(chat_id)] = {
-                    "type": "dao_choose",
-                    "matches": matches,
-                    "expires": time.time() + WAIT_CONFIRM,
-                    "timer_message_id": timer_message_id
-                }
+                set_pending(chat_id, PendingAction(
+                    type="dao_choose",
+                    matches=matches,
+                    expires=time.time() + WAIT_CONFIRM,
+                    timer_message_id=timer_message_id
+                ))
                 start_waiting_animation(chat_id, timer_message_id, WAIT_CONFIRM, interval=2.0, label="chọn đáo")
                 return
 
@@ -2335,14 +2728,14 @@ def handle_incoming_message(chat_id: int, text: str):
             )
             timer_message_id = timer_msg.get("result", {}).get("message_id")
 
-            pending_confirm[str(chat_id)] = {
-                "type": "dao_confirm",
-                "targets": [(pid, title, props)],
-                "preview_text": preview,
-                "title": title,
-                "expires": time.time() + WAIT_CONFIRM,
-                "timer_message_id": timer_message_id
-            }
+            set_pending(chat_id, PendingAction(
+                type="dao_confirm",
+                targets=[(pid, title, props)],
+                preview_text=preview,
+                title=title,
+                expires=time.time() + WAIT_CONFIRM,
+                timer_message_id=timer_message_id
+            ))
             start_waiting_animation(chat_id, timer_message_id, WAIT_CONFIRM, interval=2.0, label="xác nhận đáo")
             return
 
@@ -2361,29 +2754,27 @@ def handle_incoming_message(chat_id: int, text: str):
             return
 
         header = f"💴 {kw}\n\n✅ Đã góp: {checked}\n🟡 Chưa góp: {unchecked}\n\n📤 ngày chưa góp /cancel.\n"
-        lines = []
-        for i, (pid, title, date_iso, props) in enumerate(matches, start=1):
-            ds = date_iso[:10] if date_iso else "-"
-            lines.append(f"{i}. [{ds}] {title} ☐")
+        lines = [f"{i}. [{date_iso[:10] if date_iso else '-'}] {title} ☐"
+                 for i, (pid, title, date_iso, props) in enumerate(matches, start=1)]
 
         send_telegram(chat_id, header + "\n".join(lines))
 
         timer_msg = send_telegram(chat_id, f"⏳ Đang chờ chọn {WAIT_CONFIRM}s ...")
         timer_message_id = timer_msg.get("result", {}).get("message_id")
 
-        pending_confirm[str(chat_id)] = {
-            "type": "mark",
-            "keyword": kw,
-            "matches": matches,
-            "checked": checked,
-            "unchecked": unchecked,
-            "expires": time.time() + WAIT_CONFIRM,
-            "timer_message_id": timer_message_id
-        }
+        set_pending(chat_id, PendingAction(
+            type="mark",
+            keyword=kw,
+            matches=matches,
+            checked=checked,
+            unchecked=unchecked,
+            expires=time.time() + WAIT_CONFIRM,
+            timer_message_id=timer_message_id
+        ))
         start_waiting_animation(chat_id, timer_message_id, WAIT_CONFIRM, label="chọn đánh dấu")
 
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("handle_incoming_message failed", extra={"chat_id": chat_id})
         send_telegram(chat_id, f"❌ Lỗi xử lý: {e}")
 
 
@@ -2394,27 +2785,73 @@ def sweep_pending_expirations():
     while True:
         try:
             now = time.time()
-            keys = list(pending_confirm.keys())
-            for k in keys:
-                item = pending_confirm.get(k)
-                if item and item.get("expires") and item["expires"] < now:
-                    try:
-                        send_telegram(k, "⏳ Thao tác chờ đã hết hạn.")
-                    except Exception:
-                        pass
-                    pending_confirm.pop(k, None)
+            expired = []
+            with _pending_lock:
+                for k, item in list(pending_confirm.items()):
+                    if item.expires and item.expires < now:
+                        pending_confirm.pop(k, None)
+                        expired.append(k)
+            for k in expired:
+                send_telegram(k, "⏳ Thao tác chờ đã hết hạn.")  # send_telegram tự nuốt lỗi
         except Exception:
-            pass
+            logger.exception("sweep_pending_expirations failed")
         time.sleep(5)
 
 
-threading.Thread(target=sweep_pending_expirations, daemon=True).start()
+threading.Thread(target=sweep_pending_expirations, name="pending-sweeper", daemon=True).start()
 
 
 # =====================================================================
 #  FLASK APP / WEBHOOK
 # =====================================================================
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
+
+def is_duplicate_update(update_id) -> bool:
+    """Telegram gửi lại update khi timeout → bỏ qua update_id đã xử lý."""
+    if update_id is None:
+        return False
+    with _seen_updates_lock:
+        if update_id in _seen_updates:
+            return True
+        _seen_updates[update_id] = None
+        if len(_seen_updates) > SEEN_UPDATES_MAX:
+            _seen_updates.popitem(last=False)
+    return False
+
+
+def is_repeated_command(chat_id: int, raw: str, received_at: Optional[float] = None) -> bool:
+    """True nếu cùng chat gửi lại đúng lệnh này trong COMMAND_DEBOUNCE giây (double-tap / gửi lại).
+    received_at: time.monotonic() lúc nhận update — executor có hàng đợi thì task có thể chạy trễ
+    và không theo thứ tự, nên so theo lúc nhận chứ không theo lúc xử lý.
+    """
+    if COMMAND_DEBOUNCE <= 0:
+        return False
+    now = time.monotonic()
+    at = now if received_at is None else received_at
+    key = (chat_id, raw)
+    with _recent_commands_lock:
+        last = _recent_commands.get(key)
+        _recent_commands[key] = at if last is None else max(last, at)
+        if len(_recent_commands) > 256:
+            for k in [k for k, t in _recent_commands.items() if now - t >= COMMAND_DEBOUNCE]:
+                del _recent_commands[k]
+    return last is not None and abs(at - last) < COMMAND_DEBOUNCE
+
+
+def webhook_reply(method: str, **kwargs) -> Response:
+    """Trả lời ngay trong body của webhook → Telegram tự gọi method, đỡ 1 round-trip."""
+    return Response(json_dumps_bytes({"method": method, **kwargs}), status=200, mimetype="application/json")
 
 
 @app.route("/", methods=["GET"])
@@ -2425,29 +2862,31 @@ def index():
 @app.route("/telegram_webhook", methods=["POST"])
 @app.route("/webhook", methods=["POST"])
 def telegram_webhook():
+    body = request.get_data(cache=False)
     try:
-        data = request.get_json(force=True, silent=True) or {}
-    except Exception as e:
-        print("❌ JSON decode error:", e)
-        data = {}
+        data = json_loads(body) if body else None
+    except ValueError:  # orjson / json đều raise subclass của ValueError
+        data = None
+    if not data or not isinstance(data, dict):
+        # Body rỗng / không phải JSON → vẫn trả 200 để Telegram không gửi lại
+        return jsonify({"ok": True})
 
-    if not data:
-        return jsonify({"ok": False, "error": "no data"}), 400
+    if is_duplicate_update(data.get("update_id")):
+        return jsonify({"ok": True})
 
     message = data.get("message") or data.get("edited_message") or {}
     if not message:
         return jsonify({"ok": True})
 
-    chat = message.get("chat", {})
-    chat_id = chat.get("id")
+    chat_id = (message.get("chat") or {}).get("id")
     text_msg = message.get("text") or message.get("caption") or ""
 
-    if chat_id and text_msg:
-        threading.Thread(
-            target=handle_incoming_message,
-            args=(chat_id, text_msg),
-            daemon=True
-        ).start()
+    if isinstance(chat_id, int) and text_msg and is_allowed_chat(chat_id):
+        reply = quick_reply_text(chat_id, text_msg)
+        if reply:
+            return webhook_reply("sendMessage", chat_id=chat_id, text=reply)
+        if not submit_update(handle_incoming_message, chat_id, text_msg, time.monotonic()):
+            send_telegram(chat_id, "⚠️ Server đang bận, vui lòng thử lại sau.")
 
     return jsonify({"ok": True})
 
@@ -2460,26 +2899,27 @@ def run_polling():
     print(f"[POLLING] Bắt đầu... Token: {TELEGRAM_TOKEN[:20] if TELEGRAM_TOKEN else 'TRỐNG'}")
     while True:
         try:
-            resp = requests.get(
+            resp = TG_SESSION.get(
                 f"{api}/getUpdates",
-                params={"timeout": 30, "offset": offset},
+                # Chỉ nhận tin nhắn thường; Telegram lọc sẵn edit / callback / channel_post
+                params={"timeout": 30, "offset": offset, "allowed_updates": '["message"]'},
                 timeout=40,
             )
-            data = resp.json()
+            data = json_loads(resp.content)
             print(f"[POLLING] Updates: {len(data.get('result', []))}")
             updates = data.get("result", [])
             for upd in updates:
                 offset = upd["update_id"] + 1
-                msg = upd.get("message", {})
+                msg = upd.get("message")
+                if not msg:
+                    continue
                 text = (msg.get("text") or "").strip()
-                cid = msg.get("chat", {}).get("id")
+                cid = (msg.get("chat") or {}).get("id")
+                if not cid or not text or not is_allowed_chat(cid):
+                    continue
                 print(f"[POLLING] Tin nhắn từ {cid}: {text}")
-                if cid and text:
-                    threading.Thread(
-                        target=handle_incoming_message,
-                        args=(cid, text),
-                        daemon=True
-                    ).start()
+                if not submit_update(handle_incoming_message, cid, text, time.monotonic()):
+                    send_telegram(cid, "⚠️ Server đang bận, vui lòng thử lại sau.")
         except Exception as e:
             print(f"[POLLING] Lỗi: {e}")
             time.sleep(5)